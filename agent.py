@@ -0,0 +1,237 @@
+# vault.py
+
+import base64
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import time
+
+import errors as err
+from settings import (
+    AGENT_SOCKET,
+    AGENT_SOCKET_ENV,
+    AGENT_TIMEOUT,
+    AGENT_TTL,
+    RUNTIME_DIR_ENV,
+    VAULT_TITLE,
+)
+
+
+def get_runtime_dir():
+    runtime_dir = os.environ.get(RUNTIME_DIR_ENV)
+    if runtime_dir:
+        return os.path.join(runtime_dir, VAULT_TITLE.lower())
+    return os.path.join(
+        tempfile.gettempdir(), f'{VAULT_TITLE.lower()}-{os.getuid()}'
+    )
+
+
+def get_socket_path():
+    path = os.environ.get(AGENT_SOCKET_ENV)
+    if path:
+        return path
+    return os.path.join(get_runtime_dir(), AGENT_SOCKET)
+
+
+def is_private(path, file_type):
+    # Another user may create a shared path first, so the owner and the
+    # type are checked without following links.
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    if info.st_uid != os.getuid() or stat.S_IFMT(info.st_mode) != file_type:
+        return False
+    return file_type != stat.S_IFDIR or not info.st_mode & 0o077
+
+
+def make_socket_dir(path):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not is_private(directory, stat.S_IFDIR):
+        raise err.UnsafeSocket(directory)
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def is_private_socket(path):
+    return (
+        is_private(os.path.dirname(path) or '.', stat.S_IFDIR)
+        and is_private(path, stat.S_IFSOCK)
+    )
+
+
+def get_peer_uid(sock):
+    # Linux only, elsewhere the private directory is the only check.
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return os.getuid()
+    credentials = struct.Struct('3i')
+    _, uid, _ = credentials.unpack(
+        sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, credentials.size
+        )
+    )
+    return uid
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+            action = getattr(self.server, f'do_{message.pop("op")}')
+            response = action(**message)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            response = {'error': 'Invalid request'}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class Agent(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    timeout = AGENT_TIMEOUT
+
+    def __init__(self, path, ttl=AGENT_TTL):
+        self.ttl = ttl
+        # login -> (derived key and KDF parameters, expiry time)
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.last_used = time.monotonic()
+
+        make_socket_dir(path)
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, AgentHandler)
+        finally:
+            os.umask(old_umask)
+
+    def _touch(self):
+        self.last_used = time.monotonic()
+        return self.last_used + self.ttl
+
+    def expire_keys(self):
+        now = time.monotonic()
+        with self.lock:
+            for login, (_, expires) in list(self.keys.items()):
+                if expires <= now:
+                    del self.keys[login]
+
+    @property
+    def is_idle(self):
+        return (
+            not self.keys
+            and time.monotonic() - self.last_used > self.ttl
+        )
+
+    def run(self):
+        try:
+            while not (self.stopped or self.is_idle):
+                self.handle_request()
+                self.expire_keys()
+        finally:
+            self.server_close()
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
+
+    def do_ping(self):
+        return {'ttl': self.ttl}
+
+    def do_get(self, login):
+        with self.lock:
+            entry, _ = self.keys.get(login, (None, None))
+            if entry is None:
+                return {}
+            # Idle TTL: every use extends the lifetime of the key.
+            self.keys[login] = (entry, self._touch())
+        return entry
+
+    def do_add(self, login, key, params=None):
+        with self.lock:
+            self.keys[login] = (
+                {'key': key, 'params': params}, self._touch()
+            )
+        return {}
+
+    def do_forget(self, login=None):
+        with self.lock:
+            if login is None:
+                self.keys.clear()
+            else:
+                self.keys.pop(login, None)
+        return {}
+
+    def do_stop(self):
+        self.do_forget()
+        self.stopped = True
+        return {}
+
+
+class AgentClient:
+    def __init__(self, path=None):
+        self.path = path or get_socket_path()
+
+    def request(self, **message):
+        # Keys are sent only to an agent of the same user.
+        if not is_private_socket(self.path):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(AGENT_TIMEOUT)
+                sock.connect(self.path)
+                if get_peer_uid(sock) != os.getuid():
+                    return None
+                sock.sendall(json.dumps(message).encode() + b'\n')
+                with sock.makefile('rb') as file:
+                    return json.loads(file.readline())
+        except (OSError, ValueError):
+            return None
+
+    @property
+    def is_running(self):
+        return self.request(op='ping') is not None
+
+    def get_key(self, login):
+        response = self.request(op='get', login=login) or {}
+        key = response.get('key')
+        if key is not None:
+            return base64.b64decode(key), response.get('params')
+        return None, None
+
+    def add_key(self, login, key, params=None):
+        self.request(
+            op='add',
+            login=login,
+            key=base64.b64encode(key).decode(),
+            params=params
+        )
+
+    def forget(self, login=None):
+        self.request(op='forget', login=login)
+
+    def stop(self):
+        return self.request(op='stop') is not None
+
+
+def start(ttl=AGENT_TTL, path=None):
+    path = path or get_socket_path()
+    if AgentClient(path).is_running:
+        return path
+
+    # Bind before forking so the socket is ready when start returns.
+    agent = Agent(path, ttl)
+    if os.fork() != 0:
+        agent.socket.close()
+        return path
+
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    try:
+        agent.run()
+    finally:
+        os._exit(0)
@@ -0,0 +1,59 @@
+# vault.py
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @staticmethod
+    def _sizeof(key, value):
+        return len(key) + len(value)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = self._sizeof(key, value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= self._sizeof(key, old)
+            self.entries[key] = value
+            self.size += size
+
+            while (
+                len(self.entries) > self.max_entries
+                or self.size > self.max_bytes
+            ):
+                old_key, old_value = self.entries.popitem(last=False)
+                self.size -= self._sizeof(old_key, old_value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -1,38 +1,254 @@
 # vault.py
 
 import base64
+import hashlib
+import hmac
+import os
+import re
+import time
 import unicodedata
 
 from argon2.low_level import Type, hash_secret_raw
 
-from cryptography.fernet import Fernet
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import errors as err
+from cache import LRUCache
+from settings import (
+    BATCH_EXECUTOR,
+    BATCH_EXECUTORS,
+    BATCH_MIN_SIZE,
+    BATCH_SIZE,
+    BATCH_WORKERS,
+    CACHE_BYTES,
+    CACHE_ENTRIES,
+    KDF_MEMORY_COSTS,
+    KDF_PARAMS,
+)
+
+
+# Context string mixed into the keyed vault identifier.
+VAULT_ID_CONTEXT = b'vault-id'
+VAULT_ID_REGEXP = re.compile(r'[0-9a-f]{64}')
+# Context string for the AES-GCM key, separate from the Fernet key.
+AEAD_CONTEXT = b'vault-aead'
+# Token layout: version (1 byte) | nonce (12 bytes) | ciphertext and tag.
+AEAD_VERSION = b'\x01'
+AEAD_NONCE_SIZE = 12
+# Fernet tokens start with version 0x80 and a zero timestamp prefix.
+FERNET_PREFIX = 'gAAAAA'
+
+
+def _b64encode(data: bytes):
+    # Compact tokens: URL-safe base64 without padding.
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(token: str):
+    return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+
+
+def _encode_chunk(key, values):
+    return Encoder.from_key(key).encode_chunk(values)
+
+
+def _decode_chunk(key, tokens):
+    return Encoder.from_key(key).decode_chunk(tokens)
 
 
 class Encoder:
-    def __init__(self, login, password):
-        self.fernet = Fernet(self._get_safe_key(login, password))
+    def __init__(self, login, password, params=None, **batch):
+        params = params or KDF_PARAMS
+        self._set_key(self._get_safe_key(login, password, params), params)
+        self.set_batch(**batch)
+
+    @classmethod
+    def from_key(cls, key: bytes, params=None, **batch):
+        # Build an encoder from an already derived key (skips Argon2).
+        encoder = cls.__new__(cls)
+        encoder._set_key(key, params or KDF_PARAMS)
+        encoder.set_batch(**batch)
+        return encoder
+
+    def set_batch(self, workers=None, executor=None):
+        self.workers = workers or BATCH_WORKERS or os.cpu_count() or 1
+        self.executor = executor or BATCH_EXECUTOR
+        if self.executor not in BATCH_EXECUTORS:
+            raise err.InvalidFormat(self.executor)
+
+    def _set_key(self, key: bytes, params):
+        self.key = key
+        self.params = params
+        # Fernet requires a URL-safe base64-encoded 32-byte key.
+        # Fernet decrypts tokens written by earlier versions.
+        self.fernet = Fernet(base64.urlsafe_b64encode(key))
+        self.aead = AESGCM(HKDF(
+            algorithm=SHA256(), length=32, salt=None, info=AEAD_CONTEXT
+        ).derive(key))
+        self.vault_id = self._get_vault_id(key)
+        # Tokens are immutable, so decrypted plaintext can be reused.
+        self.cache = LRUCache(CACHE_ENTRIES, CACHE_BYTES)
 
     @staticmethod
-    def _get_safe_key(login: str, password: str):
+    def _get_safe_key(login: str, password: str, params: dict):
         # Normalize login so equivalent Unicode representations
         login = unicodedata.normalize('NFC', login)
         # Deterministic salt derived from the login.
         salt = login.encode('utf-8')
 
-        key = hash_secret_raw(
+        return hash_secret_raw(
             secret=password.encode('utf-8'),
             salt=salt,
-            time_cost=3,
-            memory_cost=16384,
-            parallelism=4,
             hash_len=32,
             type=Type.ID,
+            **params,
         )
-        # Fernet requires a URL-safe base64-encoded 32-byte key.
-        return base64.urlsafe_b64encode(key)
 
-    def encode(self, key):
-        return self.fernet.encrypt(key.encode()).decode()
+    @staticmethod
+    def _get_vault_id(key: bytes):
+        # HMAC is one-way, so the identifier reveals nothing about the key
+        # but still gives a direct dictionary lookup at sign-in.
+        return hmac.new(key, VAULT_ID_CONTEXT, hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def is_legacy_key(key: str):
+        # Legacy databases use an encrypted "login password" as vault key.
+        return not (key.startswith('$') or VAULT_ID_REGEXP.fullmatch(key))
+
+    def encrypt(self, data: bytes):
+        nonce = os.urandom(AEAD_NONCE_SIZE)
+        return AEAD_VERSION + nonce + self.aead.encrypt(nonce, data, None)
+
+    def decrypt(self, token: bytes):
+        if token[:1] != AEAD_VERSION:
+            return self.fernet.decrypt(token)
+
+        # Slice through a memoryview to avoid copying the token.
+        view = memoryview(token)
+        try:
+            return self.aead.decrypt(
+                view[1:1 + AEAD_NONCE_SIZE],
+                view[1 + AEAD_NONCE_SIZE:],
+                None
+            )
+        except InvalidTag:
+            raise InvalidToken
+
+    def _decrypt_str(self, token: str):
+        if token.startswith(FERNET_PREFIX):
+            return self.fernet.decrypt(token.encode())
+        try:
+            return self.decrypt(_b64decode(token))
+        except ValueError:
+            raise InvalidToken
+
+    def encode(self, value):
+        return _b64encode(self.encrypt(value.encode()))
 
     def decode(self, token):
-        return self.fernet.decrypt(token.encode()).decode()
+        value = self.cache.get(token)
+        if value is None:
+            value = self._decrypt_str(token).decode()
+            self.cache.put(token, value)
+        return value
+
+    def encode_blob(self, data: bytes):
+        return _b64encode(self.encrypt(data))
+
+    def decode_blob(self, token):
+        return self._decrypt_str(token)
+
+    def encode_chunk(self, values):
+        encrypt = self.encrypt
+        return [_b64encode(encrypt(value.encode())) for value in values]
+
+    def decode_chunk(self, tokens):
+        decrypt = self._decrypt_str
+        return [decrypt(token).decode() for token in tokens]
+
+    def encode_many(self, values):
+        return self._map_chunks(self.encode_chunk, _encode_chunk, values)
+
+    def decode_many(self, tokens):
+        tokens = list(tokens)
+        values = {token: self.cache.get(token) for token in tokens}
+        missing = [token for token, value in values.items() if value is None]
+        if missing:
+            decoded = self._map_chunks(
+                self.decode_chunk, _decode_chunk, missing
+            )
+            for token, value in zip(missing, decoded):
+                values[token] = value
+                self.cache.put(token, value)
+        return [values[token] for token in tokens]
+
+    def _map_chunks(self, func, process_func, items):
+        items = list(items)
+        if self.workers <= 1 or len(items) < BATCH_MIN_SIZE:
+            return func(items)
+
+        chunks = [
+            items[i:i + BATCH_SIZE] for i in range(0, len(items), BATCH_SIZE)
+        ]
+        if self.executor == 'process':
+            # Processes need a picklable function, so pass the raw key.
+            pool = ProcessPoolExecutor(self.workers)
+            func = partial(process_func, self.key)
+        else:
+            # Fernet releases the GIL inside OpenSSL, threads scale.
+            pool = ThreadPoolExecutor(self.workers)
+
+        with pool:
+            return [item for chunk in pool.map(func, chunks) for item in chunk]
+
+
+class PlainCodec:
+    def encode(self, value):
+        return value
+
+    def decode(self, value):
+        return value
+
+    def encode_many(self, values):
+        return list(values)
+
+    def decode_many(self, values):
+        return list(values)
+
+
+def _measure(params):
+    start = time.perf_counter()
+    hash_secret_raw(
+        secret=b'calibrate',
+        salt=b'calibrate',
+        hash_len=32,
+        type=Type.ID,
+        **params,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def calibrate(target_ms):
+    # Never go below the default parameters, only raise them.
+    params = dict(KDF_PARAMS)
+    for memory_cost in KDF_MEMORY_COSTS:
+        if memory_cost < params['memory_cost']:
+            continue
+        candidate = dict(params, memory_cost=memory_cost)
+        if _measure(candidate) > target_ms:
+            break
+        params = candidate
+
+    # Fill the rest of the budget with passes over the chosen memory.
+    single_pass = _measure(dict(params, time_cost=1))
+    params['time_cost'] = max(
+        KDF_PARAMS['time_cost'], int(target_ms // max(single_pass, 1))
+    )
+    return params
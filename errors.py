@@ -1,6 +1,6 @@
 # vault.py
 
-from rich import print
+import sys
 
 from settings import (
     ERROR_MESSAGE,
@@ -26,18 +26,44 @@ class ActionNotAllowedForRemote(VaultException):
     message = 'Action is not allowed for remote source'
 
 
+class AgentNotRunning(VaultException):
+    message = 'Agent is not running'
+
+
+class UnsafeSocket(VaultException):
+    def __init__(self, path, message='Socket directory is not private:'):
+        self.message = f'{message} {path}'
+        super().__init__(self.message)
+
+
+class WriteConflict(VaultException):
+    message = 'Database was changed by another process, try again'
+
+
 class LocalDataBaseNotFound(VaultException):
     def __init__(self, path, message='Database not found:'):
         self.message = f'{message} {path}'
         super().__init__(self.message)
 
 
+class DataBaseTooLarge(VaultException):
+    def __init__(self, path, message='Database too large:'):
+        self.message = f'{message} {path}'
+        super().__init__(self.message)
+
+
 class FileNotFound(VaultException):
     def __init__(self, path, message='File not found:'):
         self.message = f'{message} {path}'
         super().__init__(self.message)
 
 
+class SourceUnavailable(VaultException):
+    def __init__(self, path, message='Source unavailable:'):
+        self.message = f'{message} {path}'
+        super().__init__(self.message)
+
+
 class InvalidJSON(VaultException):
     def __init__(self, path, message='Invalid JSON:'):
         self.message = f'{message} {path}'
@@ -50,6 +76,30 @@ class InvalidDataFormat(VaultException):
         super().__init__(self.message)
 
 
+class InvalidFormat(VaultException):
+    def __init__(self, value, message='Invalid format:'):
+        self.message = f'{message} {value}'
+        super().__init__(self.message)
+
+
+class CommandFailed(VaultException):
+    def __init__(self, command, message='Cannot run command:'):
+        self.message = f'{message} {command}'
+        super().__init__(self.message)
+
+
+class AddressUnavailable(VaultException):
+    def __init__(self, address, message='Cannot listen on:'):
+        self.message = f'{message} {address}'
+        super().__init__(self.message)
+
+
+class TokenRequired(VaultException):
+    def __init__(self, name, message='Set a token to listen on TCP:'):
+        self.message = f'{message} {name}'
+        super().__init__(self.message)
+
+
 class InvalidURL(VaultException):
     def __init__(self, path, message='Invalid URL:'):
         self.message = f'{message} {path}'
@@ -96,13 +146,23 @@ class InvalidPassword(VaultException):
     message = f'Use strong password:\n{help_message}'
 
 
+def show(template, message, end='\n'):
+    # Rich renders colours on a terminal only, pipes get the plain text
+    # without loading its console.
+    if sys.stdout.isatty():
+        from rich import print as rich_print
+        rich_print(template.format(message), end=end)
+    else:
+        print(message, end=end)
+
+
 def show_notification(message, end='\n'):
-    print(NOTIFICATION_MESSAGE.format(message), end=end)
+    show(NOTIFICATION_MESSAGE, message, end)
 
 
 def show_warning(message, end='\n'):
-    print(WARNING_MESSAGE.format(message), end=end)
+    show(WARNING_MESSAGE, message, end)
 
 
 def show_error(message, end='\n'):
-    print(ERROR_MESSAGE.format(message), end=end)
+    show(ERROR_MESSAGE, message, end)
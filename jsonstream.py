@@ -0,0 +1,174 @@
+# vault.py
+
+import json
+import re
+
+import errors as err
+
+
+SPECIAL = re.compile(rb'["{}\[\]]')
+STRING_END = re.compile(rb'["\\]')
+SCALAR_END = re.compile(rb'[,}\]\s]')
+SPACE = b' \t\r\n'
+
+
+class JSONScanner:
+    # Incremental scanner over the top-level object of a JSON document.
+    # It yields keys as bytes arrive and either captures or skips values
+    # without building the rest of the document.
+
+    def __init__(self, chunks, source, max_size=None):
+        self.chunks = iter(chunks)
+        self.source = source
+        self.max_size = max_size
+        self.size = 0
+        # Dropping consumed bytes from the front and appending chunks are
+        # both cheap on a bytearray, long captured values are not copied.
+        self.buffer = bytearray()
+        self.pos = 0
+        self.mark = None
+        self.is_pending = False
+
+    def _fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise err.DataBaseTooLarge(self.source)
+
+        # Drop consumed bytes unless a value is being captured.
+        keep = min(
+            self.pos,
+            len(self.buffer),
+            self.pos if self.mark is None else self.mark
+        )
+        del self.buffer[:keep]
+        self.buffer += chunk
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark -= keep
+        return True
+
+    def _need(self, size=1):
+        while len(self.buffer) - self.pos < size:
+            if not self._fill():
+                raise err.InvalidJSON(self.source)
+
+    def _peek(self):
+        while True:
+            self._need()
+            char = self.buffer[self.pos:self.pos + 1]
+            if char not in SPACE:
+                return char
+            self.pos += 1
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise err.InvalidJSON(self.source)
+        self.pos += 1
+
+    def _search(self, pattern):
+        # Patterns match single bytes, bytes already searched are skipped
+        # after a fill. Offsets from pos survive dropping consumed bytes.
+        searched = 0
+        while True:
+            match = pattern.search(self.buffer, self.pos + searched)
+            if match is not None:
+                return match
+            searched = max(len(self.buffer) - self.pos, 0)
+            if not self._fill():
+                raise err.InvalidJSON(self.source)
+
+    def _skip_string(self):
+        # Position is after the opening quote.
+        while True:
+            match = self._search(STRING_END)
+            if match.group() == b'"':
+                self.pos = match.end()
+                return
+            # Skip the escaped character, it may be in the next chunk.
+            self.pos = match.end() + 1
+
+    def _skip_scalar(self):
+        while True:
+            match = SCALAR_END.search(self.buffer, self.pos)
+            if match is not None:
+                self.pos = match.start()
+                return
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return
+
+    def skip_value(self):
+        self.is_pending = False
+        char = self._peek()
+        if char == b'"':
+            self.pos += 1
+            self._skip_string()
+            return
+        if char not in b'{[':
+            self._skip_scalar()
+            return
+
+        depth = 0
+        while True:
+            match = self._search(SPECIAL)
+            self.pos = match.end()
+            token = match.group()
+            if token == b'"':
+                self._skip_string()
+            elif token in b'{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def read_value(self):
+        self._peek()
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            raw = self.buffer[self.mark:self.pos]
+        finally:
+            self.mark = None
+        try:
+            return json.loads(raw)
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            raise err.InvalidJSON(self.source)
+
+    def keys(self):
+        # After every key the caller reads or skips the value, values
+        # left pending are skipped before the next key.
+        if self._peek() != b'{':
+            raise err.InvalidDataFormat(self.source)
+        self.pos += 1
+
+        while True:
+            if self.is_pending:
+                self.skip_value()
+
+            char = self._peek()
+            if char == b'}':
+                return
+            if char == b',':
+                self.pos += 1
+                continue
+
+            self._expect(b'"')
+            self.mark = self.pos - 1
+            try:
+                self._skip_string()
+                raw = self.buffer[self.mark:self.pos]
+            finally:
+                self.mark = None
+            try:
+                key = json.loads(raw)
+            except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+                raise err.InvalidJSON(self.source)
+            self._expect(b':')
+
+            self.is_pending = True
+            yield key
@@ -0,0 +1,161 @@
+# vault.py
+
+import argparse
+import json
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import errors as err
+import storage
+from settings import GENERATION_HEADER, PUSH_HOST, PUSH_PORT
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    # GET /<name> serves the database, PUT, PATCH and DELETE /<name>/<key>
+    # change one key of it. The ETag of a key is its generation.
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _key(self):
+        name, _, key = self.path.lstrip('/').partition('/')
+        if name != self.server.name:
+            return None
+        return unquote(key)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _is_precondition_met(self, generation, exists):
+        if_match = self.headers.get('If-Match')
+        if if_match is not None:
+            tags = [tag.strip() for tag in if_match.split(',')]
+            # Removed keys keep their generation, so their tags still match.
+            if '*' in tags:
+                return exists
+            return f'"{generation}"' in tags
+        if self.headers.get('If-None-Match') == '*':
+            return not exists
+        return True
+
+    def do_GET(self):
+        if self._key() != '':
+            return self._send(404)
+        with open(self.server.storage.path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+            if self.headers.get('If-None-Match') == etag:
+                return self._send(304, {'ETag': etag})
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(stat.st_size))
+            self.end_headers()
+            shutil.copyfileobj(file, self.wfile)
+
+    def _write(self, method):
+        key = self._key()
+        if not key or key == GENERATION_HEADER:
+            return self._send(404 if key is None else 405)
+        try:
+            body = self._read_body()
+        except (ValueError, UnicodeDecodeError):
+            return self._send(400)
+
+        with self.server.lock:
+            data = self.server.storage.read()
+            generation = data.get(GENERATION_HEADER, {}).get(key, 0)
+            exists = key in data
+            if not self._is_precondition_met(generation, exists):
+                return self._send(412)
+
+            if method == 'DELETE':
+                if not exists:
+                    return self._send(404)
+                value = None
+            elif method == 'PATCH':
+                try:
+                    value = self.patch(data.get(key, {}), body)
+                except (AttributeError, KeyError, TypeError):
+                    return self._send(409)
+            else:
+                value = body
+
+            try:
+                generations = self.server.storage.commit(
+                    {key: value}, expected={key: generation}
+                )
+            except err.WriteConflict:
+                return self._send(412)
+        self._send(200 if exists else 201, {'ETag': f'"{generations[key]}"'})
+
+    @staticmethod
+    def patch(vault, delta):
+        # Replaces or removes the listed groups, added groups go last
+        # unless the delta carries the order.
+        vault = dict(vault)
+        for group, entries in delta['groups'].items():
+            if entries is None:
+                vault.pop(group, None)
+            else:
+                vault[group] = entries
+        if 'order' in delta:
+            return {group: vault[group] for group in delta['order']}
+        return vault
+
+    def do_PUT(self):
+        self._write('PUT')
+
+    def do_PATCH(self):
+        self._write('PATCH')
+
+    def do_DELETE(self):
+        self._write('DELETE')
+
+
+class PushServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, path):
+        self.storage = storage.JSONStorage(path)
+        self.storage.create()
+        self.name = os.path.basename(path)
+        # Writers in this process, the file lock covers the others.
+        self.lock = threading.Lock()
+        super().__init__(address, PushHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/{self.name}'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='serve a Vault DB as a writable remote source'
+    )
+    parser.add_argument('path', help='path of the JSON DB')
+    parser.add_argument('--host', default=PUSH_HOST)
+    parser.add_argument('--port', type=int, default=PUSH_PORT)
+    args = parser.parse_args()
+
+    server = PushServer((args.host, args.port), args.path)
+    print(f'push+{server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+# vault.py
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from urllib3.util.request import ACCEPT_ENCODING
+
+import errors as err
+from settings import (
+    INDEX_SUFFIX,
+    MAX_DATABASE_SIZE,
+    REMOTE_BACKOFF_MAX,
+    REMOTE_OPTIONS,
+    REMOTE_POOL_SIZE,
+    REMOTE_RETRY_STATUSES,
+    STREAM_CHUNK_SIZE,
+)
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_session():
+    # One keep-alive pool per process, shared by every remote source.
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=REMOTE_POOL_SIZE,
+                pool_maxsize=REMOTE_POOL_SIZE
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+
+def get_delay(attempt, options, response=None):
+    # Full jitter, a Retry-After from the server takes precedence.
+    if response is not None:
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(int(retry_after), REMOTE_BACKOFF_MAX)
+    return random.uniform(
+        0, min(options['backoff'] * 2 ** attempt, REMOTE_BACKOFF_MAX)
+    )
+
+
+def request(method, url, options, **kwargs):
+    # Transient failures are retried with backoff. Writes are safe to
+    # repeat because they carry preconditions.
+    for attempt in range(options['retries'] + 1):
+        is_last = attempt == options['retries']
+        try:
+            response = get_session().request(
+                method,
+                url,
+                timeout=(
+                    options['connect_timeout'], options['read_timeout']
+                ),
+                **kwargs
+            )
+        except (
+            requests.exceptions.InvalidURL,
+            requests.exceptions.MissingSchema
+        ):
+            raise err.InvalidURL(url)
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout
+        ):
+            if is_last:
+                raise err.SourceUnavailable(url)
+            time.sleep(get_delay(attempt, options))
+            continue
+        except requests.exceptions.RequestException:
+            raise err.SourceUnavailable(url)
+
+        if response.status_code not in REMOTE_RETRY_STATUSES or is_last:
+            return response
+        response.close()
+        time.sleep(get_delay(attempt, options, response))
+
+
+def fetch(url, headers, options):
+    return request('GET', url, options, stream=True, headers=headers)
+
+
+def index_url(url):
+    # The index sits next to the database, before any query string.
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(path=parts.path + INDEX_SUFFIX))
+
+
+def fetch_range(url, entry, size, options):
+    # Returns None when the server ignores ranges or the published file
+    # changed since its index, the caller then downloads the whole file.
+    offset, length, checksum = entry
+    byte_range = f'bytes {offset}-{offset + length - 1}'
+    headers = {
+        'Range': byte_range.replace(' ', '='),
+        'Accept-Encoding': 'identity',
+    }
+    try:
+        response = fetch(url, headers, options)
+        with response:
+            if (
+                response.status_code != 206
+                or response.headers.get('Content-Range')
+                != f'{byte_range}/{size}'
+            ):
+                return None
+            raw = response.content
+    except (err.SourceUnavailable, requests.exceptions.RequestException):
+        return None
+    if len(raw) != length or zlib.crc32(raw) != checksum:
+        return None
+    return raw
+
+
+class RemoteCache:
+    # On-disk copy of a remote database with its HTTP validators. Fresh
+    # copies are served without a request, stale ones are served while
+    # a background request revalidates them, and expired ones are
+    # revalidated first. Any copy is served when the source is offline.
+
+    def __init__(self, url, directory, **options):
+        self.url = url
+        self.options = {**REMOTE_OPTIONS, **options}
+        self.max_age = self.options['max_age']
+        self.stale = self.options['stale_while_revalidate']
+        # The URL may hold a token, only its digest touches the disk.
+        name = hashlib.sha256(url.encode()).hexdigest()
+        self.body_path = os.path.join(directory, f'{name}.body')
+        self.meta_path = os.path.join(directory, f'{name}.json')
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def read_meta(self):
+        try:
+            with open(self.meta_path, 'r') as file:
+                meta = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+        if not meta.get('missing') and not os.path.isfile(self.body_path):
+            return None
+        return meta
+
+    def write_meta(self, meta):
+        self._replace(self.meta_path, json.dumps(meta).encode())
+
+    def _replace(self, path, data=None, chunks=()):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as file:
+                if data is not None:
+                    file.write(data)
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _limit(self, chunks):
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            if size > MAX_DATABASE_SIZE:
+                raise err.DataBaseTooLarge(self.url)
+            yield chunk
+
+    def revalidate(self, meta=None):
+        # Conditional request, the body is downloaded only when changed.
+        headers = {'Accept-Encoding': ACCEPT_ENCODING}
+        if meta is not None and not meta.get('missing'):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        response = fetch(self.url, headers, self.options)
+        with response:
+            if meta is not None and response.status_code == 304:
+                meta = {**meta, 'fetched': time.time()}
+                self.write_meta(meta)
+                return meta
+            if response.status_code == 404:
+                # Remembered like a body, optional files are not asked
+                # for again until the copy expires.
+                meta = {'missing': True, 'fetched': time.time()}
+                self.write_meta(meta)
+                return meta
+            if (
+                response.status_code >= 500
+                or response.status_code in REMOTE_RETRY_STATUSES
+            ):
+                # Still failing after the retries, a cached copy may be
+                # served like when the source is offline.
+                raise err.SourceUnavailable(self.url)
+            if not response.ok:
+                raise err.FileNotFound(self.url)
+            try:
+                # Body first, validators of an old body are never reused.
+                self._replace(
+                    self.body_path,
+                    chunks=self._limit(
+                        response.iter_content(STREAM_CHUNK_SIZE)
+                    )
+                )
+            except requests.exceptions.RequestException:
+                raise err.SourceUnavailable(self.url)
+            meta = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched': time.time(),
+            }
+            self.write_meta(meta)
+            return meta
+
+    def is_fresh(self):
+        meta = self.read_meta()
+        return (
+            meta is not None
+            and not meta.get('missing')
+            and time.time() - meta['fetched'] < self.max_age
+        )
+
+    def invalidate(self):
+        # The next read revalidates, a local write made the copy stale.
+        meta = self.read_meta()
+        if meta is not None:
+            self.write_meta({**meta, 'fetched': 0})
+
+    def _revalidate_quietly(self, meta):
+        try:
+            self.revalidate(meta)
+        except err.VaultException:
+            pass
+
+    def stream(self):
+        meta = self.read_meta()
+        age = None if meta is None else time.time() - meta['fetched']
+        if age is None or age >= self.max_age + self.stale:
+            try:
+                meta = self.revalidate(meta)
+            except err.SourceUnavailable:
+                if meta is None:
+                    raise
+        elif age >= self.max_age:
+            # Daemon: a slow server never keeps a finished command alive.
+            threading.Thread(
+                target=self._revalidate_quietly, args=(meta,), daemon=True
+            ).start()
+
+        if meta.get('missing'):
+            raise err.FileNotFound(self.url)
+        with open(self.body_path, 'rb') as file:
+            yield from iter(lambda: file.read(STREAM_CHUNK_SIZE), b'')
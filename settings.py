@@ -37,6 +37,7 @@ FIND = 'Find'
 REMOTE = '🌐'
 LOCAL = '🟢'
 UPDATE = '🟡'
+LOADING = '⏳'
 INFO = 'Info'
 KEY = '🔑'
 COPY = '✏️'
@@ -73,3 +74,93 @@ WARNING_LABEL = 'Warning'
 NOTIFICATION_MESSAGE = '[' + GREEN + ']{}[/' + GREEN + ']'
 WARNING_MESSAGE = '[' + YELLOW + ']{}[/' + YELLOW + ']'
 ERROR_MESSAGE = '[' + RED + ']{}[/' + RED + ']'
+
+# agent
+AGENT_TTL = 900
+AGENT_SOCKET = 'agent.sock'
+AGENT_SOCKET_ENV = 'VAULT_AGENT_SOCK'
+RUNTIME_DIR_ENV = 'XDG_RUNTIME_DIR'
+AGENT_TIMEOUT = 1
+
+# key derivation
+KDF_PARAMS = {
+    'time_cost': 3,
+    'memory_cost': 16384,
+    'parallelism': 4,
+}
+KDF_HEADER = '$kdf'
+# parameter sets tried on sign-in, one Argon2 run each
+KDF_CANDIDATES = 3
+KDF_MEMORY_COSTS = [16384, 32768, 65536, 131072, 262144, 524288]
+CALIBRATE_TIME = 500
+
+# config
+VAULT_CONFIG = 'vault_config.json'
+
+# batch crypto
+BATCH_WORKERS = 0  # 0 uses every core
+BATCH_EXECUTOR = 'thread'
+BATCH_EXECUTORS = ['thread', 'process']
+BATCH_SIZE = 256
+BATCH_MIN_SIZE = 512
+
+# bulk load
+LOAD_POLICY = 'overwrite'
+LOAD_POLICIES = ['overwrite', 'merge', 'skip']
+# entries encrypted per batch call
+LOAD_BATCH_SIZE = 8192
+# invalid entries listed in the report, the rest are only counted
+LOAD_ERROR_LIMIT = 100
+
+# plaintext cache
+CACHE_ENTRIES = 4096
+CACHE_BYTES = 4 * 1024 * 1024
+
+# storage format
+VAULT_FORMAT = 'v1'
+VAULT_FORMATS = ['v1', 'v2']
+
+# storage
+LOG_SCHEME = 'log://'
+COMPACT_MIN_SIZE = 1024 * 1024
+COMPACT_RATIO = 2
+# head bytes telling compacted logs apart, inode numbers are reused
+LOG_EPOCH_SIZE = 32
+SQLITE_SCHEME = 'sqlite://'
+SQLITE_TIMEOUT = 30
+PACK_SCHEME = 'pack://'
+GENERATION_HEADER = '$generation'
+WRITE_RETRIES = 8
+WRITE_BACKOFF = 0.02
+STREAM_CHUNK_SIZE = 64 * 1024
+COMPRESSIONS = ['none', 'zlib', 'zstd']
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+MAX_DATABASE_SIZE = 256 * 1024 * 1024
+
+# remote sources
+REMOTE_CACHE = 'cache'
+# defaults of the per-source options, seconds unless noted
+REMOTE_OPTIONS = {
+    'max_age': 300,
+    'stale_while_revalidate': 3600,
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    'retries': 3,
+    'backoff': 0.5,
+}
+REMOTE_BACKOFF_MAX = 10
+REMOTE_RETRY_STATUSES = [429, 500, 502, 503, 504]
+REMOTE_POOL_SIZE = 10
+PUSH_SCHEME = 'push+'
+PUSH_HOST = '127.0.0.1'
+PUSH_PORT = 8600
+# byte ranges of vaults, published next to a plain JSON DB
+INDEX_SUFFIX = '.idx'
+
+# sidecar
+SERVE_SOCKET = 'serve.sock'
+SERVE_HOST = '127.0.0.1'
+SERVE_TOKEN_ENV = 'VAULT_SERVE_TOKEN'
+# names a TCP client may send in the Host header besides the bound host
+SERVE_ALLOWED_HOSTS = ('localhost', '127.0.0.1', '::1')
@@ -23,7 +23,9 @@ setup(
     license=LICENSE,
     py_modules=[
         'vault', 'settings',
-        'crypto', 'errors', 'mixins', 'tui', 'validators', 'widgets'
+        'agent', 'cache', 'crypto', 'errors', 'jsonstream', 'mixins',
+        'pushserver', 'remote', 'sidecar', 'storage', 'tui', 'validators',
+        'widgets'
     ],
     packages=find_packages(),
     include_package_data=True,
@@ -0,0 +1,250 @@
+# vault.py
+
+import hmac
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import agent
+import errors as err
+from settings import (
+    SERVE_ALLOWED_HOSTS,
+    SERVE_HOST,
+    SERVE_SOCKET,
+    SERVE_TOKEN_ENV,
+)
+
+
+class Sidecar:
+    # Read-only view of an unlocked vault shared by the request threads.
+    # Names are decrypted once, values on use through the LRU cache of
+    # the encoder of their layer.
+
+    def __init__(self, vlt, token=None):
+        self.vlt = vlt
+        self.token = token
+        self.entries = vlt.merge_layers()
+        self.reload_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def answer(self, query):
+        return self.vlt.answer_query(self.entries, query)
+
+    def reload(self):
+        # Requests keep the old names until the new ones are ready.
+        with self.reload_lock:
+            self.vlt.prefetch_overlays()
+            self.vlt.sign_in()
+            self.vlt.open_overlays()
+            self.entries = self.vlt.merge_layers()
+
+    def record(self, latency, status):
+        with self.lock:
+            self.requests += 1
+            if status >= 400:
+                self.errors += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def caches(self):
+        # Layers may share an encoder, plain layers have no cache.
+        codecs = {id(codec): codec for _, codec in self.vlt.get_layers()}
+        return [
+            codec.cache for codec in codecs.values()
+            if getattr(codec, 'cache', None) is not None
+        ]
+
+    def metrics(self):
+        caches = self.caches()
+        hits = sum(cache.hits for cache in caches)
+        misses = sum(cache.misses for cache in caches)
+        lookups = hits + misses
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'latency_ms': {
+                    'avg': round(
+                        1000 * self.latency / max(self.requests, 1), 3
+                    ),
+                    'max': round(1000 * self.max_latency, 3),
+                },
+                'cache': {
+                    'size': sum(len(cache) for cache in caches),
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': round(hits / lookups, 3)
+                    if lookups else 0,
+                },
+            }
+
+
+class SidecarHandler(BaseHTTPRequestHandler):
+    # GET /secrets, /secrets/<group> and /secrets/<group>/<key> list and
+    # get entries, HEAD on the same paths checks they exist. GET /metrics
+    # reports counters and POST /reload reads the vault again.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None):
+        data = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _is_authorized(self):
+        token = self.server.sidecar.token
+        if token is None:
+            return True
+        return hmac.compare_digest(
+            self.headers.get('Authorization', '').encode(),
+            f'Bearer {token}'.encode()
+        )
+
+    def _is_expected_host(self):
+        # A page of another site reaching a TCP port through DNS
+        # rebinding sends its own name, local clients send an address.
+        hosts = getattr(self.server, 'hosts', None)
+        if hosts is None:
+            return True
+        host = urlsplit(f'//{self.headers.get("Host", "")}').hostname
+        return host in hosts
+
+    def _query(self, path):
+        # Names may hold a slash, clients quote them.
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if parts[0] != 'secrets' or len(parts) > 3:
+            return None
+        if self.command == 'HEAD':
+            op = 'exists'
+        else:
+            op = 'get' if len(parts) == 3 else 'list'
+        return {'op': op, **dict(zip(('group', 'key'), parts[1:]))}
+
+    def _respond(self):
+        sidecar = self.server.sidecar
+        path = urlsplit(self.path).path
+        if not self._is_expected_host():
+            return 421, None
+        if not self._is_authorized():
+            return 401, None
+
+        if self.command == 'POST':
+            if path != '/reload':
+                return 404, None
+            try:
+                sidecar.reload()
+            except err.VaultException as e:
+                return 503, {'error': str(e)}
+            return 200, {}
+        if path == '/metrics' and self.command == 'GET':
+            return 200, sidecar.metrics()
+
+        query = self._query(path)
+        if query is None:
+            return 404, None
+        try:
+            response = sidecar.answer(query)
+        except (err.GroupNotExists, err.KeyNotExists) as e:
+            return 404, {'error': str(e)}
+        if query['op'] == 'exists':
+            return 200 if response['exists'] else 404, None
+        return 200, response
+
+    def _handle(self):
+        start = time.perf_counter()
+        # Keep-alive needs the request body read even when unused.
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, body = self._respond()
+        self._send(status, body)
+        self.server.sidecar.record(time.perf_counter() - start, status)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_HEAD(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+
+class SidecarServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, sidecar):
+        self.sidecar = sidecar
+        self.hosts = {*SERVE_ALLOWED_HOSTS, address[0].strip('[]').lower()}
+        super().__init__(address, SidecarHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+class UnixSidecarServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, sidecar):
+        self.sidecar = sidecar
+        agent.make_socket_dir(path)
+        # Only the owner may connect, like the agent socket.
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, SidecarHandler)
+        finally:
+            os.umask(old_umask)
+
+    @property
+    def url(self):
+        return self.server_address
+
+    def server_close(self):
+        super().server_close()
+        if os.path.lexists(self.server_address):
+            os.remove(self.server_address)
+
+
+def create_server(vlt, address=None):
+    # A path binds a Unix socket, anything else is HOST:PORT or a port.
+    # Every local user can reach a TCP port, so it needs a token.
+    token = os.environ.get(SERVE_TOKEN_ENV) or None
+    address = address or os.path.join(agent.get_runtime_dir(), SERVE_SOCKET)
+    is_unix = os.sep in address
+    if not is_unix and token is None:
+        raise err.TokenRequired(SERVE_TOKEN_ENV)
+    sidecar = Sidecar(vlt, token=token)
+    try:
+        if is_unix:
+            return UnixSidecarServer(address, sidecar)
+        host, _, port = address.rpartition(':')
+        return SidecarServer((host or SERVE_HOST, int(port)), sidecar)
+    except (OSError, ValueError):
+        raise err.AddressUnavailable(address)
+
+
+def serve(vlt, address=None):
+    server = create_server(vlt, address)
+    err.show_notification(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,1128 @@
+# vault.py
+
+import fcntl
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from urllib.parse import quote
+
+try:
+    import zstandard
+    ZSTD_ERRORS = (zstandard.ZstdError,)
+except ImportError:
+    zstandard = None
+    ZSTD_ERRORS = ()
+
+import errors as err
+import jsonstream
+from settings import (
+    COMPACT_MIN_SIZE,
+    COMPACT_RATIO,
+    COMPRESSIONS,
+    GENERATION_HEADER,
+    INDEX_SUFFIX,
+    LOG_EPOCH_SIZE,
+    LOG_SCHEME,
+    MAX_DATABASE_SIZE,
+    PACK_SCHEME,
+    PUSH_SCHEME,
+    SQLITE_SCHEME,
+    SQLITE_TIMEOUT,
+    STREAM_CHUNK_SIZE,
+    ZLIB_LEVEL,
+    ZSTD_LEVEL,
+)
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+@contextmanager
+def file_lock(path):
+    # Advisory lock next to the database, shared by every Vault process.
+    with open(f'{path}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def stamp_generations(generations, changes, expected=None):
+    # Optimistic concurrency: writers pass the generations of the keys
+    # they read and every commit bumps the generation of changed keys.
+    # Removed keys keep counting so a stale writer never matches again.
+    generations = dict(generations or {})
+    for key, generation in (expected or {}).items():
+        if generations.get(key, 0) != generation:
+            raise err.WriteConflict()
+    for key in changes:
+        generations[key] = generations.get(key, 0) + 1
+    return generations
+
+
+def detect_compression(head):
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    # JSON never starts with "x", the usual first byte of a zlib stream.
+    if len(head) > 1 and head[0] == 0x78 and (
+        (head[0] << 8) + head[1]
+    ) % 31 == 0:
+        return 'zlib'
+    return 'none'
+
+
+class ChunkReader:
+    # File-like reader over an iterator of byte chunks.
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def decompress(chunks, source):
+    # Yields plain chunks of a compressed or plain stream, output is
+    # bounded per chunk so the size limit also catches compression bombs.
+    chunks = iter(chunks)
+    head = b''
+    while len(head) < len(ZSTD_MAGIC):
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        head += chunk
+    compression = detect_compression(head)
+    chunks = itertools.chain([head], chunks)
+
+    if compression == 'none':
+        yield from chunks
+        return
+
+    try:
+        if compression == 'zstd':
+            if zstandard is None:
+                raise err.InvalidDataFormat(source)
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                ChunkReader(chunks)
+            )
+            yield from iter(lambda: reader.read(STREAM_CHUNK_SIZE), b'')
+            return
+
+        wbits = zlib.MAX_WBITS
+        if compression == 'gzip':
+            wbits |= 16
+        decompressor = zlib.decompressobj(wbits)
+        for chunk in chunks:
+            while chunk:
+                yield decompressor.decompress(chunk, STREAM_CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+        yield decompressor.flush()
+    except (zlib.error, *ZSTD_ERRORS):
+        raise err.InvalidDataFormat(source)
+
+
+def compress(data, compression):
+    if compression not in COMPRESSIONS:
+        raise err.InvalidFormat(compression)
+    if compression == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if compression in ('zstd', 'zlib'):
+        # Without zstandard installed zlib is the next best choice.
+        return zlib.compress(data, ZLIB_LEVEL)
+    return data
+
+
+def open_storage(source, compression=None, **remote_options):
+    if source.startswith(PUSH_SCHEME):
+        return PushStorage(source[len(PUSH_SCHEME):], **remote_options)
+    if source.startswith('http'):
+        return RemoteStorage(source, **remote_options)
+    if source.startswith(LOG_SCHEME):
+        return LogStorage(source[len(LOG_SCHEME):])
+    if source.startswith(PACK_SCHEME):
+        return PackStorage(source[len(PACK_SCHEME):])
+    if source.startswith(SQLITE_SCHEME):
+        return SQLiteStorage(source[len(SQLITE_SCHEME):])
+    return JSONStorage(source, compression)
+
+
+class Storage:
+    is_local = True
+    is_writable = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def create(self):
+        raise NotImplementedError
+
+    def load(self):
+        # Returns a read-only mapping of vault keys and headers.
+        raise NotImplementedError
+
+    def commit(self, changes, dirty=None, expected=None):
+        # Changes map keys to new values, None removes the key. Expected
+        # maps keys to the generations the writer read, any other writer
+        # in between raises WriteConflict. Returns the new generations.
+        raise NotImplementedError
+
+    def compact(self):
+        return False
+
+
+class StreamView:
+    # Read-only view of a JSON database parsed as it streams in. Lookups
+    # scan only up to the requested key and skip the other values, so a
+    # sign-in stops at the caller's vault.
+    def __init__(self, open_stream, source):
+        self.open_stream = open_stream
+        self.source = source
+        self.found = {}
+        self.seen = {}
+        self.scanner = None
+        self.scan = None
+        self.pending = None
+        self.complete = False
+
+    def _restart(self):
+        self.scanner = jsonstream.JSONScanner(
+            self.open_stream(), self.source, MAX_DATABASE_SIZE
+        )
+        self.scan = self.scanner.keys()
+        self.pending = None
+
+    def _next_key(self):
+        if self.pending is not None:
+            return self.pending
+        self.pending = next(self.scan, None)
+        if self.pending is None:
+            self.complete = True
+        else:
+            self.seen[self.pending] = None
+        return self.pending
+
+    def _find(self, wanted):
+        if wanted in self.seen and wanted != self.pending:
+            # Passed over earlier, read the stream again from the start.
+            self._restart()
+        elif self.complete:
+            return False
+        elif self.scan is None:
+            self._restart()
+
+        while True:
+            key = self._next_key()
+            if key is None:
+                return False
+            # Headers are written first, they cannot follow a vault.
+            if wanted.startswith('$') and not key.startswith('$'):
+                return False
+            self.pending = None
+            # Headers are small, keep them all for the next lookup.
+            if key == wanted or key.startswith('$'):
+                self.found[key] = self.scanner.read_value()
+            if key == wanted:
+                return True
+
+    def __contains__(self, key):
+        return key in self.found or self._find(key)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.found[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self.found[key]
+        return default
+
+    def keys(self):
+        if self.scan is None:
+            self._restart()
+        while self._next_key() is not None:
+            self.pending = None
+        return list(self.seen)
+
+    def items(self):
+        scanner = jsonstream.JSONScanner(
+            self.open_stream(), self.source, MAX_DATABASE_SIZE
+        )
+        for key in scanner.keys():
+            yield key, scanner.read_value()
+
+
+class RangeView:
+    # Read-only view of a published database. Vaults are fetched on their
+    # own with Range requests at the offsets of the index. Once a range
+    # shows the index is stale, the whole database is read instead.
+    def __init__(self, storage, index):
+        self.storage = storage
+        self.headers = index['headers']
+        self.vaults = index['vaults']
+        self.size = index['size']
+        self.found = {}
+        self.full = None
+
+    def _full(self):
+        if self.full is None:
+            self.full = StreamView(self.storage.stream, self.storage.path)
+        return self.full
+
+    def _find(self, key):
+        if self.full is not None:
+            return key in self.full
+        # The index holds every header, a missing one is not published.
+        if key.startswith('$'):
+            if key in self.headers:
+                self.found[key] = self.headers[key]
+            return key in self.found
+        if key not in self.vaults:
+            # Wrong passwords and other KDF candidates end here, a fresh
+            # index lists every vault.
+            return False
+        import remote
+        raw = remote.fetch_range(
+            self.storage.path,
+            self.vaults[key],
+            self.size,
+            self.storage.cache.options
+        )
+        if raw is not None:
+            self.found[key] = json.loads(raw)
+            return True
+        # Size or checksum mismatch: the database changed since the index.
+        return key in self._full()
+
+    def __contains__(self, key):
+        return key in self.found or self._find(key)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.found:
+            return self.found[key]
+        return self.full[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        # Legacy vault ids are tried on every failed sign-in.
+        if self.full is not None:
+            return self.full.keys()
+        return [*self.headers, *self.vaults]
+
+    def items(self):
+        return self._full().items()
+
+
+class JSONStorage(Storage):
+    def __init__(self, path, compression=None):
+        super().__init__(path)
+        # Compression of new writes, None keeps the one of the file.
+        self.compression = compression
+        self.detected = None
+
+    def create(self):
+        with file_lock(self.path):
+            if not os.path.isfile(self.path):
+                self.write({})
+
+    def read(self):
+        try:
+            data = json.loads(b''.join(self.stream()))
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            raise err.InvalidJSON(self.path)
+        if not isinstance(data, dict):
+            raise err.InvalidDataFormat(self.path)
+        return data
+
+    def write(self, data):
+        # Keep the headers first so readers find them without a full scan.
+        data = {
+            **{
+                key: value for key, value in data.items()
+                if key.startswith('$') and value
+            },
+            **{
+                key: value for key, value in data.items()
+                if not key.startswith('$')
+            },
+        }
+        compression = self.compression or self.detected or 'none'
+        if compression == 'gzip':
+            compression = 'zlib'
+        tmp_path = f'{self.path}.tmp'
+        # One token per line keeps diffs of the database small.
+        with open(tmp_path, 'wb') as file:
+            file.write(
+                compress(json.dumps(data, indent=1).encode(), compression)
+            )
+            file.flush()
+            os.fsync(file.fileno())
+        # Copy-on-write: readers keep streaming the file they opened.
+        os.replace(tmp_path, self.path)
+
+    def publish(self, data):
+        # Plain JSON with one key per line and an index of the byte range
+        # of every vault, remote readers fetch just their own vault.
+        keys = sorted(data, key=lambda key: not key.startswith('$'))
+        index = {'headers': {}, 'vaults': {}}
+        lines = []
+        offset = len(b'{\n')
+        for key in keys:
+            prefix = json.dumps(key).encode() + b': '
+            raw = json.dumps(data[key]).encode()
+            if key.startswith('$'):
+                index['headers'][key] = data[key]
+            else:
+                index['vaults'][key] = [
+                    offset + len(prefix), len(raw), zlib.crc32(raw)
+                ]
+            lines.append(prefix + raw)
+            offset += len(prefix) + len(raw) + len(b',\n')
+        body = b'{\n' + b',\n'.join(lines) + b'\n}\n'
+        index['size'] = len(body)
+
+        index_path = f'{self.path}{INDEX_SUFFIX}'
+        for path, content in (
+            (self.path, body), (index_path, json.dumps(index).encode())
+        ):
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(content)
+            os.replace(tmp_path, path)
+        return index_path
+
+    def stream(self):
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            raise err.LocalDataBaseNotFound(os.path.basename(self.path))
+        with file:
+            self.detected = detect_compression(file.read(len(ZSTD_MAGIC)))
+            file.seek(0)
+            yield from decompress(
+                iter(lambda: file.read(STREAM_CHUNK_SIZE), b''), self.path
+            )
+
+    def load(self):
+        return StreamView(self.stream, self.path)
+
+    def compact(self):
+        # Rewrites the database when the configured compression differs.
+        with file_lock(self.path):
+            data = self.read()
+            if self.compression in (None, self.detected):
+                return False
+            self.write(data)
+        return True
+
+    def commit(self, changes, dirty=None, expected=None):
+        with file_lock(self.path):
+            data = self.read()
+            generations = stamp_generations(
+                data.get(GENERATION_HEADER), changes, expected
+            )
+            for key, value in changes.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            data[GENERATION_HEADER] = generations
+            self.write(data)
+        return generations
+
+
+class RemoteStorage(Storage):
+    is_local = False
+    is_writable = False
+
+    def __init__(self, path, cache_dir, **cache_options):
+        # Requests is loaded only when a remote source is opened.
+        import remote
+        super().__init__(path)
+        self.cache = remote.RemoteCache(path, cache_dir, **cache_options)
+        self.index_cache = remote.RemoteCache(
+            remote.index_url(path), cache_dir, **cache_options
+        )
+
+    def exists(self):
+        return True
+
+    def stream(self):
+        # Content encodings (gzip, br) are decoded while downloading, the
+        # cached body itself may be a compressed database.
+        yield from decompress(self.cache.stream(), self.path)
+
+    def load_index(self):
+        try:
+            index = json.loads(b''.join(self.index_cache.stream()))
+            return index if isinstance(index, dict) else None
+        except (
+            err.FileNotFound,
+            err.SourceUnavailable,
+            err.DataBaseTooLarge,
+            UnicodeDecodeError,
+            json.decoder.JSONDecodeError
+        ):
+            return None
+
+    def load(self):
+        # A fresh copy of the whole database needs no request at all.
+        index = None if self.cache.is_fresh() else self.load_index()
+        if index is not None:
+            try:
+                return RangeView(self, index)
+            except KeyError:
+                pass
+        return StreamView(self.stream, self.path)
+
+    def commit(self, changes, dirty=None, expected=None):
+        raise err.ActionNotAllowedForRemote()
+
+
+class PushStorage(RemoteStorage):
+    # Writable remote source. Every changed key is sent on its own with
+    # its generation as the precondition, vaults with known dirty groups
+    # are patched group by group.
+    is_writable = True
+
+    def key_url(self, key):
+        return f'{self.path}/{quote(key, safe="")}'
+
+    def commit(self, changes, dirty=None, expected=None):
+        dirty = dirty or {}
+        expected = expected or {}
+        generations = {}
+        try:
+            # Removals go last so a failed push never drops the only copy.
+            for key in sorted(
+                changes, key=lambda name: changes[name] is None
+            ):
+                generations[key] = self.push(
+                    key, changes[key], dirty.get(key), expected.get(key)
+                )
+        finally:
+            # A conflict means the copy is stale too, the replay after it
+            # has to read the new generations.
+            self.cache.invalidate()
+        return generations
+
+    def push(self, key, value, dirty=None, generation=None):
+        headers = {}
+        if generation == 0:
+            headers['If-None-Match'] = '*'
+        elif generation is not None:
+            headers['If-Match'] = f'"{generation}"'
+
+        if value is None:
+            method, body = 'DELETE', None
+        elif isinstance(value, dict) and dirty is not None and generation:
+            method = 'PATCH'
+            body = {
+                'groups': {group: value.get(group) for group in dirty}
+            }
+            # Added groups go last, a rename has to restore the order.
+            if (
+                any(group in value for group in dirty)
+                and any(group not in value for group in dirty)
+            ):
+                body['order'] = list(value)
+        else:
+            method, body = 'PUT', value
+
+        import remote
+        response = remote.request(
+            method,
+            self.key_url(key),
+            self.cache.options,
+            json=body,
+            headers=headers
+        )
+        with response:
+            if response.status_code == 412:
+                raise err.WriteConflict()
+            if response.status_code == 404:
+                raise err.FileNotFound(self.path)
+            if not response.ok:
+                raise err.SourceUnavailable(self.path)
+            return int(response.headers['ETag'].strip('"'))
+
+
+class LogIndex:
+    # Read-only view of a log; the open file survives compaction.
+    def __init__(self, file, index):
+        self.file = file
+        self.index = index
+        self.lock = threading.Lock()
+
+    def __del__(self):
+        self.file.close()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        offset, length = self.index[key]
+        with self.lock:
+            self.file.seek(offset)
+            line = self.file.read(length)
+        return LogStorage.parse_value(line)
+
+    def keys(self):
+        return self.index.keys()
+
+    def items(self):
+        for key in list(self.index):
+            yield key, self[key]
+
+    def get(self, key, default=None):
+        if key in self.index:
+            return self[key]
+        return default
+
+
+class LogStorage(Storage):
+    # Every line is "<crc32> <op> <key>\t<json>\n" with op P (put) or
+    # D (delete). Readers replay only the line headers to build an index
+    # of the latest put per key, values are parsed on demand.
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.compaction = None
+        # Index of the file with this inode up to size, kept between
+        # calls so a commit reads only what other writers appended.
+        self.lock = threading.Lock()
+        self.identity = None
+        self.index = {}
+        self.size = 0
+        self.live = 0
+        self.generations = (None, None)
+
+    def create(self):
+        if not os.path.isfile(self.path):
+            open(self.path, 'ab').close()
+
+    @staticmethod
+    def make_record(key, value):
+        if value is None:
+            body = f'D {key}\t'.encode()
+        else:
+            body = f'P {key}\t'.encode() + json.dumps(value).encode()
+        return b'%08x ' % zlib.crc32(body) + body + b'\n'
+
+    @staticmethod
+    def parse_head(line):
+        # Returns (op, key) or None for torn and corrupted records.
+        if not line.endswith(b'\n') or len(line) < 12:
+            return None
+        body = line[9:-1]
+        try:
+            if int(line[:8], 16) != zlib.crc32(body):
+                return None
+            head, _ = body.split(b'\t', 1)
+            op, key = head.decode().split(' ', 1)
+        except ValueError:
+            return None
+        return op, key
+
+    @staticmethod
+    def parse_value(line):
+        return json.loads(line[line.index(b'\t') + 1:])
+
+    def scan(self, file, index, offset=0, live=0):
+        # Replays complete lines from offset, a line still being written
+        # is left for the next scan. Returns the new offset and the bytes
+        # of the live records.
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            record = self.parse_head(line)
+            if record is not None:
+                op, key = record
+                if key in index:
+                    live -= index.pop(key)[1]
+                if op == 'P':
+                    index[key] = (offset, len(line))
+                    live += len(line)
+            offset += len(line)
+        return offset, live
+
+    def refresh(self, file):
+        # Only records appended since the last call are read, a file
+        # replaced by compaction is read again from the start.
+        with self.lock:
+            # Inode numbers are reused, the head of a compacted file
+            # holds a random epoch and never shrinks or changes otherwise.
+            info = os.fstat(file.fileno())
+            file.seek(0)
+            identity = (info.st_dev, info.st_ino, file.read(LOG_EPOCH_SIZE))
+            if identity != self.identity or info.st_size < self.size:
+                self.identity = identity
+                self.index, self.size, self.live = {}, 0, 0
+            self.size, self.live = self.scan(
+                file, self.index, self.size, self.live
+            )
+            return dict(self.index)
+
+    def read_generations(self, file):
+        # The header is decoded once per record, not on every commit.
+        record = self.index.get(GENERATION_HEADER)
+        if record is None:
+            return None
+        if self.generations[0] != (self.identity, record):
+            file.seek(record[0])
+            self.generations = (
+                (self.identity, record),
+                self.parse_value(file.read(record[1]))
+            )
+        return self.generations[1]
+
+    def load(self):
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            raise err.LocalDataBaseNotFound(os.path.basename(self.path))
+        return LogIndex(file, self.refresh(file))
+
+    def commit(self, changes, dirty=None, expected=None):
+        with file_lock(self.path):
+            with open(self.path, 'ab+') as file:
+                self.refresh(file)
+                generations = stamp_generations(
+                    self.read_generations(file), changes, expected
+                )
+                records = b''.join(
+                    self.make_record(key, value) for key, value in {
+                        **changes, GENERATION_HEADER: generations
+                    }.items()
+                )
+                # Start on a fresh line after a torn write.
+                if file.seek(0, os.SEEK_END) > 0:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b'\n':
+                        records = b'\n' + records
+                file.write(records)
+                file.flush()
+                os.fsync(file.fileno())
+                self.refresh(file)
+                self.generations = (
+                    (self.identity, self.index[GENERATION_HEADER]),
+                    generations
+                )
+        if self.needs_compaction():
+            self.schedule_compaction()
+        return generations
+
+    def needs_compaction(self):
+        # Sizes are kept up to date by the scans, no read is needed.
+        return (
+            self.size >= COMPACT_MIN_SIZE
+            and self.size > COMPACT_RATIO * self.live
+        )
+
+    def schedule_compaction(self):
+        # Non-daemon thread: the process finishes compaction before exit.
+        # It runs only once the log doubled, so writes rarely wait for it.
+        if self.compaction is not None and self.compaction.is_alive():
+            return
+        self.compaction = threading.Thread(target=self.compact)
+        self.compaction.start()
+
+    def compact(self):
+        tmp_path = f'{self.path}.tmp'
+        with file_lock(self.path):
+            with open(self.path, 'rb') as file:
+                index = self.refresh(file)
+                with open(tmp_path, 'wb') as tmp:
+                    # Not a record, scans skip it like a torn line.
+                    tmp.write(
+                        b'# ' + os.urandom(LOG_EPOCH_SIZE // 2).hex().encode()
+                        + b'\n'
+                    )
+                    for offset, length in index.values():
+                        file.seek(offset)
+                        tmp.write(file.read(length))
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+            os.replace(tmp_path, self.path)
+        return True
+
+
+class SQLiteView:
+    # Reads of one view share a snapshot: a vault, its entries and the
+    # generations never come from different commits.
+    def __init__(self, connection, snapshot=False):
+        self.connection = connection
+        self.snapshot = snapshot
+        if snapshot:
+            connection.execute('BEGIN')
+
+    def __del__(self):
+        # Closing ends the read transaction, WAL writers never wait on it.
+        if self.snapshot:
+            self.connection.close()
+
+    def __contains__(self, key):
+        if key.startswith('$'):
+            query = 'SELECT 1 FROM headers WHERE name = ?'
+        else:
+            query = 'SELECT 1 FROM vaults WHERE id = ?'
+        return self.connection.execute(query, (key,)).fetchone() is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def keys(self):
+        return [
+            key for key, in self.connection.execute(
+                'SELECT name FROM headers UNION ALL SELECT id FROM vaults'
+            )
+        ]
+
+    def items(self):
+        for key in self.keys():
+            yield key, self.get(key)
+
+    def get(self, key, default=None):
+        if key.startswith('$'):
+            row = self.connection.execute(
+                'SELECT value FROM headers WHERE name = ?', (key,)
+            ).fetchone()
+            return default if row is None else json.loads(row[0])
+
+        row = self.connection.execute(
+            'SELECT groups, blob FROM vaults WHERE id = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return default
+        groups, blob = row
+        if blob is not None:
+            return blob
+
+        vault = {group: {} for group in json.loads(groups)}
+        for group, name, value in self.connection.execute(
+            'SELECT grp, key, value FROM entries '
+            'WHERE vault_id = ? ORDER BY position',
+            (key,)
+        ):
+            vault[group][name] = value
+        return vault
+
+
+class SQLiteStorage(Storage):
+    # One row per vault with the group order (or the v2 blob) and one
+    # row per encrypted entry, so saves rewrite only the dirty groups.
+    schema = [
+        'CREATE TABLE IF NOT EXISTS headers '
+        '(name TEXT PRIMARY KEY, value TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS vaults '
+        '(id TEXT PRIMARY KEY, groups TEXT, blob TEXT)',
+        'CREATE TABLE IF NOT EXISTS entries ('
+        'vault_id TEXT NOT NULL, grp TEXT NOT NULL, key TEXT NOT NULL, '
+        'value TEXT NOT NULL, position INTEGER NOT NULL, '
+        'PRIMARY KEY (vault_id, grp, key))',
+    ]
+
+    def connect(self):
+        try:
+            connection = sqlite3.connect(
+                self.path, timeout=SQLITE_TIMEOUT, isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            raise err.InvalidDataFormat(self.path)
+        return connection
+
+    def create(self):
+        connection = self.connect()
+        with connection:
+            for statement in self.schema:
+                connection.execute(statement)
+        connection.close()
+
+    def connect_existing(self):
+        # Any SQLite file opens, one without the tables is not a Vault DB.
+        if not self.exists():
+            raise err.LocalDataBaseNotFound(os.path.basename(self.path))
+        connection = self.connect()
+        tables = {
+            name for name, in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+        if not {'headers', 'vaults', 'entries'} <= tables:
+            connection.close()
+            raise err.InvalidDataFormat(self.path)
+        return connection
+
+    def load(self):
+        return SQLiteView(self.connect_existing(), snapshot=True)
+
+    @staticmethod
+    def _insert_groups(connection, key, vault, groups):
+        connection.executemany(
+            'INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+            [
+                (key, group, name, value, position)
+                for group in groups if group in vault
+                for position, (name, value) in enumerate(
+                    vault[group].items()
+                )
+            ]
+        )
+
+    def commit(self, changes, dirty=None, expected=None):
+        dirty = dirty or {}
+        connection = self.connect_existing()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            generations = stamp_generations(
+                SQLiteView(connection).get(GENERATION_HEADER),
+                changes,
+                expected
+            )
+            self._commit_header(connection, GENERATION_HEADER, generations)
+            for key, value in changes.items():
+                if key == GENERATION_HEADER:
+                    continue
+                if key.startswith('$'):
+                    self._commit_header(connection, key, value)
+                else:
+                    self._commit_vault(
+                        connection, key, value, dirty.get(key)
+                    )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+        return generations
+
+    @staticmethod
+    def _commit_header(connection, key, value):
+        if value is None:
+            connection.execute('DELETE FROM headers WHERE name = ?', (key,))
+        else:
+            connection.execute(
+                'INSERT OR REPLACE INTO headers VALUES (?, ?)',
+                (key, json.dumps(value))
+            )
+
+    def _commit_vault(self, connection, key, value, dirty):
+        exists = connection.execute(
+            'SELECT blob IS NULL FROM vaults WHERE id = ?', (key,)
+        ).fetchone()
+        if value is None or isinstance(value, str) or not (
+            exists and exists[0]
+        ):
+            # Removed, single-blob or new vaults have no entries to keep.
+            dirty = None
+
+        if value is None:
+            connection.execute('DELETE FROM vaults WHERE id = ?', (key,))
+        elif isinstance(value, str):
+            connection.execute(
+                'INSERT OR REPLACE INTO vaults VALUES (?, NULL, ?)',
+                (key, value)
+            )
+        else:
+            connection.execute(
+                'INSERT OR REPLACE INTO vaults VALUES (?, ?, NULL)',
+                (key, json.dumps(list(value)))
+            )
+
+        if dirty is None:
+            connection.execute(
+                'DELETE FROM entries WHERE vault_id = ?', (key,)
+            )
+            if isinstance(value, dict):
+                self._insert_groups(connection, key, value, value)
+        else:
+            connection.executemany(
+                'DELETE FROM entries WHERE vault_id = ? AND grp = ?',
+                [(key, group) for group in dirty]
+            )
+            self._insert_groups(connection, key, value, dirty)
+
+
+class PackView:
+    # Read-only view of a memory-mapped pack, lookups touch only the index
+    # pages on the binary search path and the byte range of one record.
+    def __init__(self, file):
+        self.file = file
+        # __del__ runs even when mmap fails on an empty file.
+        self.map = None
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.count = PackStorage.header.unpack_from(self.map)
+        except struct.error:
+            raise ValueError('Truncated pack')
+        index_end = (
+            PackStorage.header.size + self.count * PackStorage.slot.size
+        )
+        if magic != PackStorage.magic or index_end > len(self.map):
+            raise ValueError('Invalid pack')
+
+    def __del__(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def _slot(self, position):
+        offset = PackStorage.header.size + position * PackStorage.slot.size
+        return PackStorage.slot.unpack_from(self.map, offset)
+
+    def _record(self, offset, length):
+        size, = PackStorage.key_size.unpack_from(self.map, offset)
+        start = offset + PackStorage.key_size.size
+        key = self.map[start:start + size].decode()
+        return key, start + size, offset + length
+
+    def find(self, key):
+        # Returns (value start, value end) of the key or None.
+        digest = PackStorage.digest(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._slot(middle)[0] < digest:
+                low = middle + 1
+            else:
+                high = middle
+
+        while low < self.count:
+            slot_digest, offset, length = self._slot(low)
+            if slot_digest != digest:
+                break
+            name, start, end = self._record(offset, length)
+            if name == key:
+                return start, end
+            low += 1
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __getitem__(self, key):
+        found = self.find(key)
+        if found is None:
+            raise KeyError(key)
+        return json.loads(self.map[found[0]:found[1]])
+
+    def get(self, key, default=None):
+        found = self.find(key)
+        if found is None:
+            return default
+        return json.loads(self.map[found[0]:found[1]])
+
+    def raw_items(self):
+        # Yields (key, record bytes) without parsing any value.
+        for position in range(self.count):
+            _, offset, length = self._slot(position)
+            name, _, _ = self._record(offset, length)
+            yield name, self.map[offset:offset + length]
+
+    def keys(self):
+        return [name for name, _ in self.raw_items()]
+
+    def items(self):
+        for position in range(self.count):
+            _, offset, length = self._slot(position)
+            name, start, end = self._record(offset, length)
+            yield name, json.loads(self.map[start:end])
+
+
+class PackStorage(Storage):
+    # Layout: header (magic, count), index of fixed slots sorted by key
+    # digest (digest, offset, length), then records (key size, key, JSON).
+    magic = b'VLTPACK1'
+    header = struct.Struct('>8sQ')
+    slot = struct.Struct('>8sQQ')
+    key_size = struct.Struct('>H')
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha256(key.encode()).digest()[:8]
+
+    @classmethod
+    def make_record(cls, key, value):
+        name = key.encode()
+        return cls.key_size.pack(len(name)) + name + json.dumps(value).encode()
+
+    def create(self):
+        with file_lock(self.path):
+            if not os.path.isfile(self.path):
+                self.write({})
+
+    def load(self):
+        try:
+            return PackView(open(self.path, 'rb'))
+        except FileNotFoundError:
+            raise err.LocalDataBaseNotFound(os.path.basename(self.path))
+        except ValueError:
+            raise err.InvalidDataFormat(self.path)
+
+    def write(self, records):
+        # Records map keys to encoded record bytes.
+        items = sorted(records.items(), key=lambda item: self.digest(item[0]))
+        offset = self.header.size + len(items) * self.slot.size
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(self.header.pack(self.magic, len(items)))
+            for key, record in items:
+                file.write(
+                    self.slot.pack(self.digest(key), offset, len(record))
+                )
+                offset += len(record)
+            for _, record in items:
+                file.write(record)
+            file.flush()
+            os.fsync(file.fileno())
+        # Copy-on-write: open views keep reading the previous file.
+        os.replace(tmp_path, self.path)
+
+    def commit(self, changes, dirty=None, expected=None):
+        with file_lock(self.path):
+            view = self.load()
+            generations = stamp_generations(
+                view.get(GENERATION_HEADER), changes, expected
+            )
+            records = dict(view.raw_items())
+            for key, value in {
+                **changes, GENERATION_HEADER: generations
+            }.items():
+                if value is None:
+                    records.pop(key, None)
+                else:
+                    records[key] = self.make_record(key, value)
+            self.write(records)
+        return generations
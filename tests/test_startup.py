@@ -0,0 +1,91 @@
+# vault.py
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOGIN = 'alice@example.com'
+PASSWORD = 'password'
+
+# Modules only the TUI, the banner, the sidecar and remote sources need.
+HEAVY_MODULES = ('art', 'requests', 'rich', 'sidecar', 'textual', 'tui')
+# Only commands that open a source or sign in need these.
+SIGN_IN_MODULES = ('agent', 'argon2', 'crypto', 'cryptography', 'sqlite3',
+                   'storage')
+# Import of the CLI without key derivation, generous for slow machines.
+IMPORT_BUDGET = 1.0
+
+SIGN_UP = f'''
+import vault
+vlt = vault.Vault(None, True)
+vlt.set_user({LOGIN!r}, {PASSWORD!r})
+vlt.add_data('group', 'key', 'value')
+'''
+
+RUN = f'''
+import json, sys, time
+start = time.perf_counter()
+import validators
+import vault
+elapsed = time.perf_counter() - start
+validators.getpass.getpass = lambda prompt='': {PASSWORD!r}
+sys.argv = ['vault'] + sys.argv[1:]
+vault.main()
+loaded = sorted({{name.split('.')[0] for name in sys.modules}})
+print(json.dumps({{'import': elapsed, 'modules': loaded}}), file=sys.stderr)
+'''
+
+
+class TestStartup(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.home = tempfile.TemporaryDirectory()
+        cls.env = {
+            **os.environ,
+            'HOME': cls.home.name,
+            'PYTHONPATH': ROOT,
+            'XDG_DATA_HOME': os.path.join(cls.home.name, 'data'),
+        }
+        cls.python('-c', SIGN_UP)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.home.cleanup()
+
+    @classmethod
+    def python(cls, *args):
+        return subprocess.run(
+            [sys.executable, *args], env=cls.env, cwd=cls.home.name,
+            capture_output=True, text=True, check=True, timeout=60
+        )
+
+    def run_vault(self, *args, heavy=HEAVY_MODULES):
+        result = self.python('-c', RUN, *args)
+        report = json.loads(result.stderr.strip().splitlines()[-1])
+        loaded = set(heavy) & set(report['modules'])
+        self.assertFalse(loaded, f'{args} imports {sorted(loaded)}')
+        self.assertLess(report['import'], IMPORT_BUDGET)
+        return result.stdout
+
+    def test_version(self):
+        output = self.run_vault('-v', heavy=HEAVY_MODULES + SIGN_IN_MODULES)
+        self.assertTrue(output.strip())
+
+    def test_info(self):
+        output = self.run_vault('-i', heavy=HEAVY_MODULES + SIGN_IN_MODULES)
+        self.assertIn('MIT', output)
+
+    def test_get(self):
+        self.assertIn('value', self.run_vault(LOGIN, '-g', 'group', 'key'))
+
+    def test_list(self):
+        self.assertIn('group', self.run_vault(LOGIN, '-l'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 # vault.py
 
+import asyncio
 import os
 from enum import Enum
 
@@ -38,6 +39,7 @@ from settings import (
     ERROR_LABEL,
     INFO,
     LOAD,
+    LOADING,
     LOCAL,
     LOCAL_STYLE,
     NOTIFICATION_LABEL,
@@ -74,6 +76,8 @@ class ViewApp(App):
         super().__init__(*args, **kwargs)
         self.vlt = vlt
         self.state = State.LOCAL
+        # Background sign-in to a new source, None when idle.
+        self.loading = None
 
     def watch_state_type(self, value):
         for binding in self.bindings.shown_keys:
@@ -86,7 +90,7 @@ class ViewApp(App):
                 cells=self._create_cells()
             )
 
-        if self.vlt.is_local_source:
+        if self.vlt.is_writable_source:
             self.state = State.LOCAL
             self.state_type = f'{SOURCE} {LOCAL}'
             self.footer.style = LOCAL_STYLE
@@ -95,6 +99,9 @@ class ViewApp(App):
             self.state_type = f'{SOURCE} {REMOTE}'
             self.footer.style = REMOTE_STYLE
 
+        if self.loading is not None:
+            self.state_type = f'{SOURCE} {LOADING}'
+
         self.footer._key_text = None
         self.footer.refresh(layout=True)
 
@@ -142,7 +149,7 @@ class ViewApp(App):
         self.whoami.action = (
             lambda: self.notification.show(
                 NOTIFICATION_LABEL,
-                self.vlt.encoder.decode(self.vlt.key),
+                self.vlt.login,
                 GREEN
             )
         )
@@ -215,7 +222,12 @@ class ViewApp(App):
             err.KeyAlreadyExists,
             err.KeyNotExists,
             err.ActionNotAllowedForRemote,
-            err.LocalDataBaseNotFound
+            err.LocalDataBaseNotFound,
+            err.WriteConflict,
+            err.SourceUnavailable,
+            err.FileNotFound,
+            err.InvalidURL,
+            err.DataBaseTooLarge
         ) as e:
             self.notification.show(ERROR_LABEL, str(e), RED)
 
@@ -304,70 +316,57 @@ class ViewApp(App):
         self.cells_grid.visible = True
 
     def _set_source(self):
-        login, password = (
-            self.vlt.encoder.decode(self.vlt.key).split(' ')
-        )
-        old_key = self.vlt.key
-        old_source = self.vlt.vault_db
         source = self.source_update.label
 
         self.source_update.label = self.vlt.get_default_source()
         self.source_update.hide()
+        if self.loading is not None:
+            self.loading.cancel()
+        self.loading = asyncio.ensure_future(self._load_source(source))
+        self._set_source_mode()
+
+    async def _load_source(self, source):
+        loop = asyncio.get_running_loop()
         try:
-            self.vlt.set_source(source)
-            self.vlt.get_user(login, password)
-            self.cells_grid.update_cells(cells=self._create_cells())
-            self._show_notification_load_json()
+            # Downloads and decryption run in a thread, the current vault
+            # stays usable until the new one replaces it.
+            vlt = await loop.run_in_executor(
+                None, self.vlt.open_source, source
+            )
         except (
             err.LocalDataBaseNotFound,
             err.FileNotFound,
+            err.SourceUnavailable,
             err.InvalidJSON,
             err.InvalidDataFormat,
             err.InvalidURL,
+            err.DataBaseTooLarge,
             err.LoginFailed
         ) as e:
-            title = ERROR_LABEL
-            label = str(e)
-            color = RED
-
-            self.notification.show(title, label, color)
-
-            try:
-                self.vlt.key = old_key
-                self.vlt.set_source(old_source)
-                self.vlt.get_user(login, password)
-                self.set_timer(
-                    NOTIFICATION_TIME,
-                    self._show_notification_load_json
-                )
-            except err.LoginFailed:
-                self.vlt.key = old_key
-                self.vlt.set_source(old_source)
-                self.vlt.set_user(login, password)
-                self.set_timer(
-                    NOTIFICATION_TIME,
-                    self._show_notification_load_json
-                )
-            except (
-                err.LocalDataBaseNotFound,
-                err.FileNotFound,
-                err.InvalidJSON,
-                err.InvalidDataFormat,
-                err.InvalidURL,
-                err.LoginFailed
-            ) as e:
-                label = str(e)
-
-                self.set_timer(
-                    NOTIFICATION_TIME,
-                    lambda: self.notification.show(
-                        title, label, color
-                    )
-                )
-
-        self._set_source_mode()
+            self.notification.show(ERROR_LABEL, str(e), RED)
+            self.set_timer(
+                NOTIFICATION_TIME,
+                self._show_notification_load_json
+            )
+        else:
+            self.vlt = vlt
+            self.cells_grid.update_cells(cells=self._create_cells())
+            self._show_notification_load_json()
+        finally:
+            # A newer load may have replaced this one.
+            if self.loading is asyncio.current_task():
+                self.loading = None
+                self._set_source_mode()
 
     def action_set_source(self):
+        if self.loading is not None:
+            # The thread finishes on its own, its vault is dropped.
+            self.loading.cancel()
+            self.loading = None
+            self.notification.show(WARNING_LABEL, 'Loading cancelled', YELLOW)
+            self._set_source_mode()
+            return
+
         self.source_update.label = self.vlt.get_default_source()
         self.source_update.visible = not self.source_update.visible
         self.source_button.visible = not self.source_button.visible
@@ -414,17 +413,25 @@ class ViewApp(App):
         if path:
             try:
                 self.action_load_data()
-                self.vlt.load_data(path)
+                report = self.vlt.load_data(path)
                 self.cells_grid.update_cells(
                     cells=self._create_cells()
                 )
-                self._show_notification_load_json()
+                self.notification.show(
+                    WARNING_LABEL if report['invalid'] else NOTIFICATION_LABEL,
+                    self.vlt.load_summary(report),
+                    YELLOW if report['invalid'] else GREEN
+                )
             except (
                 err.ActionNotAllowedForRemote,
                 err.LocalDataBaseNotFound,
                 err.FileNotFound,
                 err.InvalidJSON,
-                err.InvalidDataFormat
+                err.InvalidDataFormat,
+                err.WriteConflict,
+                err.SourceUnavailable,
+                err.InvalidURL,
+                err.DataBaseTooLarge
             ) as e:
                 self.notification.show(ERROR_LABEL, str(e), RED)
         elif directory:
@@ -445,16 +452,16 @@ class ViewApp(App):
         await self.load_json.update(tree)
 
     def _create_cells(self, action=None):
+        # Names are decrypted in batches, values only when a cell is clicked.
         instances = []
-        for group in self.vlt.vault:
-            for key in self.vlt.vault[group]:
-                value = self.vlt.vault.get(group, {})
+        for title, entries in self.vlt.merge_layers().items():
+            for label, (value, codec) in entries.items():
                 instances.append(
                     CellButton(
-                        encoder=self.vlt.encoder,
-                        title=group,
-                        label=key,
-                        value=value.get(key),
+                        encoder=codec,
+                        title=title,
+                        label=label,
+                        value=value,
                         action=action,
                         name='cell',
                     )
@@ -32,39 +32,85 @@
 # shiv -c vault -o vault --preamble preamble.py .
 
 import argparse
+import concurrent.futures
+import functools
 import json
 import os
+import random
+import re
 import sys
 import time
+import zlib
 
 from appdirs import user_data_dir
 
-from art import tprint
-
-from cryptography.fernet import InvalidToken
-
-import requests
-
-import crypto
+# crypto (cryptography, argon2), storage (sqlite3, mmap) and agent are
+# imported by the commands that open a source or sign in.
 import errors as err
+import jsonstream
 from settings import (
+    AGENT_TTL,
     AUTHOR,
+    CALIBRATE_TIME,
     DESCRIPTION,
     EMAIL,
+    GENERATION_HEADER,
+    KDF_CANDIDATES,
+    KDF_HEADER,
+    KDF_PARAMS,
     LICENSE,
+    LOAD_BATCH_SIZE,
+    LOAD_ERROR_LIMIT,
+    LOAD_POLICIES,
+    LOAD_POLICY,
+    REMOTE_CACHE,
+    REMOTE_OPTIONS,
+    STREAM_CHUNK_SIZE,
     TITLE_FONT,
     URL,
+    VAULT_CONFIG,
     VAULT_DB,
+    VAULT_FORMAT,
+    VAULT_FORMATS,
     VAULT_TITLE,
     VERSION,
+    WRITE_BACKOFF,
+    WRITE_RETRIES,
 )
-import tui
 import validators
 
 
+def retry_on_conflict(method):
+    # Another process saved first: replay the edit on the stored vault.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        for attempt in range(WRITE_RETRIES):
+            try:
+                return method(self, *args, **kwargs)
+            except err.WriteConflict:
+                if attempt == WRITE_RETRIES - 1:
+                    raise
+                time.sleep(random.uniform(0, WRITE_BACKOFF * 2 ** attempt))
+                self.refresh_vault()
+    return wrapper
+
+
+PLACEHOLDER = re.compile(r'\{\{\s*([^{}]+?)\s*\}\}')
+
+
 class Vault:
-    def __init__(self, source=None, is_piped=False):
+    def __init__(self, source=None, is_piped=False, workers=None):
         self.vault = {}
+        # Encrypted groups changed since the last save, None for all.
+        self.dirty = set()
+        # Generation of the stored vault this copy is based on.
+        self.generation = 0
+        self.rekey_encoder = None
+        self.format = VAULT_FORMAT
+        # Read-only sources under the primary one and their open vaults.
+        self.overlays = []
+        self.layers = []
+        self.prefetch = []
 
         self.local_dir = user_data_dir(f'{VAULT_TITLE}DB')
         self.set_source()
@@ -73,14 +119,31 @@ class Vault:
         self.set_source(source)
 
         self.is_piped = is_piped
+        self.batch = {
+            'workers': workers or self.get_config().get('workers'),
+            'executor': self.get_config().get('executor'),
+        }
 
     @property
     def is_empty(self):
-        return not bool(self.vault)
+        return not any(vault for vault, _ in self.get_layers())
+
+    @property
+    def codec(self):
+        # Entries of a single-blob vault are plaintext in memory.
+        if self.format == 'v2':
+            import crypto
+            return crypto.PlainCodec()
+        return self.encoder
 
     @property
     def is_local_source(self):
-        return not self.vault_db.startswith('http')
+        # A merged view is read-only like a remote source.
+        return self.storage.is_local and not self.overlays
+
+    @property
+    def is_writable_source(self):
+        return self.storage.is_writable and not self.overlays
 
     def get_default_source(self):
         return f'{self.local_dir}/{VAULT_DB}'
@@ -90,139 +153,424 @@ class Vault:
             self.vault_db = source
         else:
             self.vault_db = self.get_default_source()
+        self.storage = self.open_storage(self.vault_db)
+
+    def open_storage(self, source):
+        import storage
+        return storage.open_storage(
+            source,
+            compression=self.get_config().get('compression'),
+            cache_dir=os.path.join(self.local_dir, REMOTE_CACHE),
+            **self.get_source_options(source)
+        )
+
+    def set_overlays(self, sources):
+        # Sources listed first take precedence, downloads start at once
+        # and run while the key is derived.
+        self.overlays = [self.open_storage(source) for source in sources]
+        self.layers = []
+        self.prefetch_overlays()
+
+    def prefetch_overlays(self):
+        if not self.overlays:
+            self.prefetch = []
+            return
+        executor = concurrent.futures.ThreadPoolExecutor(len(self.overlays))
+        self.prefetch = [
+            executor.submit(self._prefetch_overlay, overlay)
+            for overlay in self.overlays
+        ]
+        executor.shutdown(wait=False)
+
+    @staticmethod
+    def _prefetch_overlay(overlay):
+        database = overlay.load()
+        database.get(KDF_HEADER)
+        return database
+
+    def _open_overlay(self, future):
+        database = future.result()
+        key = self.get_vault_key(database)
+        if key is None:
+            return None
+        vault_format, vault = self.read_vault(database, key)
+        if vault_format == 'v2':
+            import crypto
+            return vault, crypto.PlainCodec()
+        return vault, self.encoder
+
+    def open_overlays(self):
+        # Overlays are unlocked with the key of the primary vault, those
+        # without a vault for it are left out.
+        if not self.prefetch:
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+            len(self.prefetch)
+        ) as executor:
+            self.layers = [
+                layer for layer in executor.map(
+                    self._open_overlay, self.prefetch
+                )
+                if layer is not None
+            ]
+
+    def get_layers(self):
+        return [(self.vault, self.codec), *self.layers]
+
+    def merge_layers(self):
+        # Plaintext names mapped to the encrypted value and its codec,
+        # entries of earlier layers win.
+        merged = {}
+        for vault, codec in self.get_layers():
+            groups = list(vault)
+            for group, title in zip(groups, codec.decode_many(groups)):
+                keys = list(vault[group])
+                entries = merged.setdefault(title, {})
+                for key, label in zip(keys, codec.decode_many(keys)):
+                    entries.setdefault(label, (vault[group][key], codec))
+        return merged
+
+    def get_source_options(self, source):
+        # Global options, then those of the longest matching URL prefix.
+        config = self.get_config()
+        options = {
+            name: config[name] for name in REMOTE_OPTIONS if name in config
+        }
+        prefixes = [
+            prefix for prefix in config.get('sources', {})
+            if source.startswith(prefix)
+        ]
+        if prefixes:
+            options.update(config['sources'][max(prefixes, key=len)])
+        return options
 
     def set_default_database(self):
-        if not os.path.isdir(self.local_dir):
-            os.mkdir(self.local_dir)
-        if not os.path.isfile(self.vault_db):
-            with open(self.vault_db, 'w') as file:
-                json.dump(self.vault, file)
+        os.makedirs(self.local_dir, exist_ok=True)
+        self.storage.create()
+
+    def create_database(self):
+        # Writes create a local source on first use, create is idempotent.
+        if self.storage.is_local:
+            self.storage.create()
+
+    def get_config_path(self):
+        return f'{self.local_dir}/{VAULT_CONFIG}'
+
+    def get_config(self):
+        try:
+            with open(self.get_config_path(), 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def set_config(self, **config):
+        config = {**self.get_config(), **config}
+        with open(self.get_config_path(), 'w') as file:
+            json.dump(config, file)
+
+    def get_kdf_params(self):
+        return self.get_config().get('kdf', KDF_PARAMS)
+
+    def get_kdf_candidates(self, database):
+        # The configured and default parameters, then those most vaults
+        # of the database use. Each one costs a key derivation.
+        recorded = list(database.get(KDF_HEADER, {}).values())
+        candidates = []
+        for params in [
+            self.get_kdf_params(),
+            KDF_PARAMS,
+            *sorted(recorded, key=recorded.count, reverse=True)
+        ]:
+            if params not in candidates:
+                candidates.append(params)
+        return candidates[:KDF_CANDIDATES]
+
+    def calibrate(self, target_ms, verbose=True):
+        import crypto
+        params = crypto.calibrate(target_ms)
+        self.set_config(kdf=params)
+        if verbose:
+            err.show_notification(
+                ' '.join(f'{name}={value}' for name, value in params.items())
+            )
+        else:
+            return params
 
-    def get_key_str(self, login, password):
-        return f'{login} {password}'
+    def set_encoder(self, login, password, params=None):
+        import crypto
+        self.login = login
+        self.encoder = crypto.Encoder(login, password, params, **self.batch)
+
+    def set_encoder_key(self, login, key, params=None):
+        import crypto
+        self.login = login
+        self.encoder = crypto.Encoder.from_key(key, params, **self.batch)
 
     def set_user(self, login, password):
-        self.encoder = crypto.Encoder(login, password)
+        self.set_encoder(login, password, self.get_kdf_params())
+        self.sign_up()
+
+    @retry_on_conflict
+    def sign_up(self):
+        self.create_database()
         database = self.get_database()
-        self.key = self.get_vault_key(login, password, database)
+        self.key = self.get_vault_key(database)
         if not self.key:
-            self.set_vault_key(login, password)
+            self.set_vault_key()
+            self.generation = self.get_generation(database)
+            self.format = self.get_config().get('format', VAULT_FORMAT)
             self.save_vault()
         else:
             raise err.UserExists()
 
-    def get_user(self, login, password):
-        self.encoder = crypto.Encoder(login, password)
+    def get_user(self, login, password, rekey=True):
+        database = self.get_database()
+        for params in self.get_kdf_candidates(database):
+            self.set_encoder(login, password, params)
+            self.key = self.get_vault_key(database)
+            if self.key is not None:
+                break
+        self.open_vault(database)
+
+        params = self.get_kdf_params()
+        if (
+            rekey and self.is_local_source and self.encoder.params != params
+        ):
+            # Re-key with the configured parameters on the next save.
+            import crypto
+            self.rekey_encoder = crypto.Encoder(
+                login, password, params, **self.batch
+            )
+
+    def sign_in(self):
         database = self.get_database()
-        self.key = self.get_vault_key(login, password, database)
+        self.key = self.get_vault_key(database)
+        self.open_vault(database)
+
+    def open_source(self, source):
+        # Signs in to another source on a new Vault with the same key, this
+        # one stays usable until the other one is ready.
+        vlt = Vault(source, self.is_piped, self.batch['workers'])
+        vlt.login = self.login
+        vlt.encoder = self.encoder
+        vlt.sign_in()
+        return vlt
+
+    def open_vault(self, database):
         if self.key is not None:
             self.vault = self.load_vault(database)
+            self.generation = self.get_generation(database)
+            self.dirty = set()
+            self.migrate_vault_key()
         else:
             raise err.LoginFailed()
 
-    def set_vault_key(self, login, password):
-        self.key = self.encoder.encode(
-            self.get_key_str(login, password)
-        )
+    def refresh_vault(self):
+        # Drops unsaved changes and reloads the stored vault.
+        database = self.get_database()
+        if self.key in database:
+            self.vault = self.load_vault(database)
+        self.generation = self.get_generation(database)
+        self.dirty = set()
+
+    def mark_dirty(self, *groups):
+        # None marks the whole vault, also after a failed save.
+        if self.dirty is not None:
+            self.dirty.update(groups)
+
+    def get_generation(self, database, key=None):
+        return database.get(GENERATION_HEADER, {}).get(key or self.key, 0)
+
+    def set_vault_key(self):
+        self.key = self.encoder.vault_id
 
     def get_database(self):
-        try:
-            if self.is_local_source:
-                with open(self.vault_db, 'r') as file:
-                    return json.load(file)
-            else:
-                response = requests.get(self.vault_db)
+        return self.storage.load()
 
-                if response.ok:
-                    return json.loads(response.content)
-                else:
-                    raise err.FileNotFound(self.vault_db)
+    def get_vault_key(self, database):
+        if self.encoder.vault_id in database:
+            return self.encoder.vault_id
+        if self.encoder.params != KDF_PARAMS:
+            return
 
-        except FileNotFoundError:
-            raise err.LocalDataBaseNotFound(
-                os.path.basename(self.vault_db)
-            )
-        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
-            raise err.InvalidJSON(self.vault_db)
-        except requests.exceptions.InvalidURL:
-            raise err.InvalidURL(self.vault_db)
-        except requests.exceptions.MissingSchema:
-            raise err.InvalidURL(self.vault_db)
-        except AttributeError:
-            raise err.InvalidDataFormat(self.vault_db)
-
-    def get_vault_key(self, login, password, database):
-        key_str = self.get_key_str(login, password)
+        # Fall back to trial decryption for vaults not migrated yet.
+        import crypto
+        from cryptography.fernet import InvalidToken
         for key in database.keys():
+            if not crypto.Encoder.is_legacy_key(key):
+                continue
             try:
-                if self.encoder.decode(key) == key_str:
-                    return key
+                self.encoder.decode(key)
+                return key
             except InvalidToken:
                 pass
 
+    def migrate_vault_key(self):
+        if self.key == self.encoder.vault_id or not self.is_local_source:
+            return
+        database = self.get_database()
+        vault = database.get(self.key)
+        expected = {
+            self.key: self.generation,
+            self.encoder.vault_id: self.get_generation(
+                database, self.encoder.vault_id
+            ),
+        }
+        try:
+            generations = self.storage.commit(
+                {self.key: None, self.encoder.vault_id: vault},
+                expected=expected
+            )
+        except err.WriteConflict:
+            # Another process is migrating it, keep the old key for now.
+            return
+        self.set_vault_key()
+        self.generation = generations[self.key]
+
     def encode_vault(self):
-        crt_vault = {}
-        for group in self.vault:
-            crt_group = self.encoder.encode(group)
-            crt_vault[crt_group] = {}
-            for key in self.vault[group]:
-                crt_key = self.encoder.encode(key)
-                crt_val = self.encoder.encode(self.vault[group][key])
-                crt_vault[crt_group][crt_key] = crt_val
-        return crt_vault
+        return self._map_vault(self.codec.encode_many)
 
     def decode_vault(self):
-        cln_vault = {}
-        for group in self.vault:
-            cln_group = self.encoder.decode(group)
-            cln_vault[cln_group] = {}
-            for key in self.vault[group]:
-                cln_key = self.encoder.decode(key)
-                cln_val = self.encoder.decode(self.vault[group][key])
-                cln_vault[cln_group][cln_key] = cln_val
-        return cln_vault
+        return self._map_vault(self.codec.decode_many)
+
+    def _map_vault(self, map_many):
+        # Flatten the vault so the whole vault goes through one batch call.
+        groups = list(self.vault)
+        entries = [
+            (group, key) for group in groups for key in self.vault[group]
+        ]
+        mapped = map_many([
+            *groups,
+            *(key for _, key in entries),
+            *(self.vault[group][key] for group, key in entries)
+        ])
+
+        mapped_groups = dict(zip(groups, mapped))
+        mapped_keys = mapped[len(groups):len(groups) + len(entries)]
+        mapped_values = mapped[len(groups) + len(entries):]
+
+        vault = {mapped_groups[group]: {} for group in groups}
+        for (group, _), key, value in zip(
+            entries, mapped_keys, mapped_values
+        ):
+            vault[mapped_groups[group]][key] = value
+        return vault
 
     def save_vault(self):
-        self.vault = self.encode_vault()
-        data = {}
-
-        if not self.is_local_source:
+        if not self.is_writable_source:
             raise err.ActionNotAllowedForRemote()
-        try:
-            with open(self.vault_db, 'r') as file:
-                data = json.load(file)
 
-            with open(self.vault_db, 'w') as file:
-                data[self.key] = self.vault
-                json.dump(data, file)
-        except FileNotFoundError:
-            raise err.LocalDataBaseNotFound(
-                os.path.basename(self.vault_db)
+        old_key = self.key
+        old_encoder = self.encoder
+        old_vault, old_dirty = self.vault, self.dirty
+        if self.rekey_encoder is not None:
+            vault = self.decode_vault()
+            self.encoder, self.rekey_encoder = self.rekey_encoder, None
+            self.set_vault_key()
+            self.vault = vault
+            self.vault = self.encode_vault()
+            self.dirty = None
+
+        try:
+            changes = {self.key: self.dump_vault()}
+            expected = {old_key: self.generation}
+            database = None
+            if old_key != self.key:
+                # Removed keys keep counting, a key used before is not at 0.
+                database = self.get_database()
+                changes[old_key] = None
+                expected[self.key] = self.get_generation(database, self.key)
+            self.update_kdf_header(changes, expected, old_key, database)
+            generations = self.storage.commit(
+                changes, {self.key: self.dirty}, expected
             )
+        except Exception:
+            if old_key != self.key:
+                # Re-key again on the next save or when the edit is
+                # replayed, the unsaved edit stays under the old key.
+                self.encoder, self.rekey_encoder = old_encoder, self.encoder
+                self.key = old_key
+                self.vault, self.dirty = old_vault, old_dirty
+            raise
+        self.generation = generations[self.key]
+        self.dirty = set()
+
+    def update_kdf_header(
+        self, changes, expected, old_key=None, database=None
+    ):
+        # Adds the header to the changes when the KDF parameters moved.
+        params = None
+        if self.encoder.params != KDF_PARAMS:
+            params = self.encoder.params
+        if params is None and old_key in (None, self.key):
+            return
+
+        if database is None:
+            database = self.get_database()
+        header = database.get(KDF_HEADER, {})
+        if header.get(self.key) == params and old_key in (None, self.key):
+            return
+
+        header = dict(header)
+        header.pop(old_key, None)
+        header.pop(self.key, None)
+        if params is not None:
+            header[self.key] = params
+        changes[KDF_HEADER] = header
+        expected[KDF_HEADER] = self.get_generation(database, KDF_HEADER)
 
     def load_vault(self, database):
-        return database.get(self.key)
+        self.format, vault = self.read_vault(database, self.key)
+        return vault
 
+    def read_vault(self, database, key):
+        vault = database.get(key)
+        if isinstance(vault, str):
+            try:
+                return 'v2', json.loads(
+                    zlib.decompress(self.encoder.decode_blob(vault))
+                )
+            except (zlib.error, json.decoder.JSONDecodeError):
+                raise err.InvalidDataFormat(self.vault_db)
+        return 'v1', vault
+
+    def dump_vault(self):
+        if self.format == 'v2':
+            # One compressed, authenticated blob for the whole vault.
+            return self.encoder.encode_blob(
+                zlib.compress(json.dumps(self.vault).encode())
+            )
+        return self.vault
+
+    @retry_on_conflict
+    def convert_vault(self, vault_format):
+        if vault_format not in VAULT_FORMATS:
+            raise err.InvalidFormat(vault_format)
+        vault = self.decode_vault()
+        self.format = vault_format
+        self.vault = vault
+        self.vault = self.encode_vault()
+        self.dirty = None
+        self.save_vault()
+
+    @retry_on_conflict
     def remove_vault(self):
-        data = {}
-        if not self.is_local_source:
+        if not self.is_writable_source:
             raise err.ActionNotAllowedForRemote()
-        try:
-            with open(self.vault_db, 'r') as file:
-                data = json.load(file)
 
-            with open(self.vault_db, 'w') as file:
-                del data[self.key]
-                json.dump(data, file)
-
-        except FileNotFoundError:
-            raise err.LocalDataBaseNotFound(
-                os.path.basename(self.vault_db)
-            )
-
-        err.show_warning(
-            f'{self.encoder.decode(self.key)}'
-        )
+        database = self.get_database()
+        changes = {self.key: None}
+        expected = {self.key: self.generation}
+        header = database.get(KDF_HEADER, {})
+        if self.key in header:
+            changes[KDF_HEADER] = {
+                key: params for key, params in header.items()
+                if key != self.key
+            }
+            expected[KDF_HEADER] = self.get_generation(database, KDF_HEADER)
+        self.storage.commit(changes, expected=expected)
+
+        err.show_warning(self.login)
 
     def get_json_path(self):
         name = str(time.time()).replace('.', '')
@@ -241,23 +589,179 @@ class Vault:
         else:
             return path
 
-    def load_data(self, path):
+    @retry_on_conflict
+    def load_data(self, path, policy=LOAD_POLICY):
+        # Overwrite replaces the vault, merge lets imported entries win and
+        # skip keeps the existing ones. Invalid entries are reported and
+        # left out, the valid ones are still saved.
+        if policy not in LOAD_POLICIES:
+            raise err.InvalidFormat(policy)
+
+        if policy == 'overwrite':
+            vault, names = {}, {}
+        else:
+            vault = {group: dict(keys) for group, keys in self.vault.items()}
+            names = self.map_names(vault)
+        report = {'added': 0, 'updated': 0, 'skipped': 0, 'invalid': 0}
+        errors = []
+        dirty = set()
+
+        batch = []
+        for group, key, value, error in self.read_entries(path):
+            if error is not None:
+                report['invalid'] += 1
+                if len(errors) < LOAD_ERROR_LIMIT:
+                    errors.append(error)
+                continue
+            if key in names.get(group, (None, {}))[1]:
+                if policy == 'skip':
+                    report['skipped'] += 1
+                    continue
+                report['updated'] += 1
+            else:
+                report['added'] += 1
+            batch.append((group, key, value))
+            if len(batch) >= LOAD_BATCH_SIZE:
+                self._load_batch(vault, names, batch, dirty)
+                batch = []
+        self._load_batch(vault, names, batch, dirty)
+
+        self.vault = vault
+        self.dirty = None if policy == 'overwrite' else dirty
+        self.save_vault()
+        report['errors'] = errors
+        return report
+
+    @staticmethod
+    def load_summary(report):
+        return ', '.join(
+            f'{name.capitalize()}: {report[name]}'
+            for name in ('added', 'updated', 'skipped', 'invalid')
+        )
+
+    def map_names(self, vault):
+        # Plaintext names of groups and keys mapped to the encrypted ones.
+        groups = list(vault)
+        names = {}
+        for group, title in zip(groups, self.codec.decode_many(groups)):
+            keys = list(vault[group])
+            names[title] = (
+                group, dict(zip(self.codec.decode_many(keys), keys))
+            )
+        return names
+
+    @staticmethod
+    def read_entries(path):
+        # Streams (group, key, value, error), a single group is in memory
+        # at a time.
         try:
-            with open(path, 'r') as file:
-                self.vault = json.load(file)
-                self.save_vault()
+            file = open(path, 'rb')
         except FileNotFoundError:
             raise err.FileNotFound(path)
-        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
-            raise err.InvalidJSON(path)
-        except AttributeError:
-            raise err.InvalidDataFormat(path)
+        with file:
+            scanner = jsonstream.JSONScanner(
+                iter(lambda: file.read(STREAM_CHUNK_SIZE), b''), path
+            )
+            for group in scanner.keys():
+                entries = scanner.read_value()
+                if not isinstance(entries, dict):
+                    yield group, None, None, f'{group}: not an object'
+                    continue
+                for key, value in entries.items():
+                    if isinstance(value, str):
+                        yield group, key, value, None
+                    else:
+                        yield group, key, None, f'{group}.{key}: not a string'
+
+    def _load_batch(self, vault, names, batch, dirty):
+        # One batch call encrypts the new group names, keys and values.
+        new_groups = list(dict.fromkeys(
+            group for group, _, _ in batch if group not in names
+        ))
+        tokens = self.codec.encode_many([
+            *new_groups,
+            *(key for _, key, _ in batch),
+            *(value for _, _, value in batch),
+        ])
+        for group, token in zip(new_groups, tokens):
+            names[group] = (token, {})
+            vault[token] = {}
+
+        keys = tokens[len(new_groups):len(new_groups) + len(batch)]
+        values = tokens[len(new_groups) + len(batch):]
+        for (group, key, _), key_token, value_token in zip(
+            batch, keys, values
+        ):
+            crt_group, crt_keys = names[group]
+            # Existing keys keep their token and their position.
+            crt_key = crt_keys.setdefault(key, key_token)
+            vault[crt_group][crt_key] = value_token
+            dirty.add(crt_group)
 
     def get_database_path(self):
         return self.vault_db
 
+    def import_database(self, path, verbose=True):
+        if not self.is_local_source:
+            raise err.ActionNotAllowedForRemote()
+
+        import storage
+        data = storage.JSONStorage(path).read()
+        # Generations count commits to this database, the stamped ones win.
+        data.pop(GENERATION_HEADER, None)
+        self.create_database()
+        header = {
+            **self.get_database().get(KDF_HEADER, {}),
+            **data.pop(KDF_HEADER, {})
+        }
+        if header:
+            data[KDF_HEADER] = header
+        self.storage.commit(data)
+
+        if verbose:
+            err.show_notification(self.vault_db)
+        else:
+            return self.vault_db
+
+    def export_database(self, path, verbose=True):
+        import storage
+        storage.JSONStorage(path).write(dict(self.get_database().items()))
+
+        if verbose:
+            err.show_notification(path)
+        else:
+            return path
+
+    def publish_database(self, path, verbose=True):
+        import storage
+        index_path = storage.JSONStorage(path).publish(
+            dict(self.get_database().items())
+        )
+
+        if verbose:
+            err.show_notification(f'{path}, {index_path}')
+        else:
+            return path, index_path
+
+    def compact_database(self, verbose=True):
+        if not self.is_local_source:
+            raise err.ActionNotAllowedForRemote()
+        if not self.storage.exists():
+            raise err.LocalDataBaseNotFound(
+                os.path.basename(self.vault_db)
+            )
+
+        compacted = self.storage.compact()
+        if verbose:
+            if compacted:
+                err.show_notification(self.vault_db)
+            else:
+                err.show_warning(f'Nothing to compact: {self.vault_db}')
+        else:
+            return compacted
+
     def find_database(self, path, verbose=True):
-        if self.is_local_source and not os.path.exists(path):
+        if self.is_local_source and not self.storage.exists():
             raise err.LocalDataBaseNotFound(
                 os.path.basename(self.vault_db)
             )
@@ -267,7 +771,8 @@ class Vault:
         else:
             return path
 
-    def info(self, verbose=True):
+    @staticmethod
+    def info(verbose=True):
         info = f'{VAULT_TITLE} v{VERSION} {LICENSE}'
         desc = f'{DESCRIPTION}\n{URL}'
         author = f'{AUTHOR}\n{EMAIL}'
@@ -277,40 +782,169 @@ class Vault:
         else:
             return message
 
-    def version(self):
+    @staticmethod
+    def version():
         err.show_notification(VERSION)
 
-    def get_data(self, group, key):
-        decoded = self.decode_vault()
-        group = decoded.get(group, {})
+    @staticmethod
+    def _find(names, codec, name):
+        for crt_name in names:
+            if codec.decode(crt_name) == name:
+                return crt_name
+
+    def find_group(self, group):
+        return self._find(self.vault, self.codec, group)
+
+    def find_key(self, crt_group, key):
+        return self._find(self.vault.get(crt_group, {}), self.codec, key)
 
+    def get_value(self, group, key):
+        # Decrypt only the names on the way and the single value, layers
+        # are searched in order of precedence.
+        for vault, codec in self.get_layers():
+            crt_group = self._find(vault, codec, group)
+            crt_key = self._find(vault.get(crt_group, {}), codec, key)
+            if crt_key is not None:
+                return codec.decode(vault[crt_group][crt_key])
+        return ''
+
+    def get_data(self, group, key):
         end = '\n'
         if self.is_piped:
             end = ''
 
-        err.show_notification(group.get(key, ''), end=end)
+        err.show_notification(self.get_value(group, key), end=end)
 
     def list_data(self):
-        decoded = self.decode_vault()
-        for group in decoded:
-            keys = '\n\t'.join(decoded[group].keys())
+        for group, entries in self.merge_layers().items():
+            keys = '\n\t'.join(entries)
             err.show_warning(group)
             err.show_notification(
                 f'\t{keys}'
             )
 
-    def add_data(self, group, key, value):
-        decoded = self.decode_vault()
-
-        decoded[group] = decoded.get(group, {})
+    @staticmethod
+    def answer_query(entries, query):
+        op = query.get('op')
+        group = query.get('group')
+        key = query.get('key')
+        if op == 'exists':
+            return {
+                'exists': group in entries
+                and (key is None or key in entries[group])
+            }
+        if op == 'list' and group is None:
+            return {
+                'groups': {
+                    title: list(labels) for title, labels in entries.items()
+                }
+            }
+        if op not in ('get', 'list'):
+            raise ValueError(op)
+
+        if group not in entries:
+            raise err.GroupNotExists(group)
+        if op == 'list':
+            return {'keys': list(entries[group])}
+        if key not in entries[group]:
+            raise err.KeyNotExists(key)
+        value, codec = entries[group][key]
+        return {'value': codec.decode(value)}
+
+    def process_batch(self, lines, output):
+        # One unlock for many NDJSON queries: names are decrypted once and
+        # every query decrypts at most one value.
+        entries = self.merge_layers()
+        for line in lines:
+            if not line.strip():
+                continue
+            query = None
+            try:
+                query = json.loads(line)
+                response = self.answer_query(entries, query)
+            except err.VaultException as e:
+                response = {'error': str(e)}
+            except (AttributeError, TypeError, ValueError):
+                response = {'error': 'Invalid request'}
+            if isinstance(query, dict) and 'id' in query:
+                response = {'id': query['id'], **response}
+            output.write(json.dumps(response) + '\n')
+            output.flush()
+
+    def get_group(self, group):
+        entries = self.merge_layers()
+        if group not in entries:
+            raise err.GroupNotExists(group)
+        return {
+            key: codec.decode(value)
+            for key, (value, codec) in entries[group].items()
+        }
+
+    def exec_command(self, group, command):
+        # Replaces this process, the values never touch the disk.
+        env = {**os.environ, **self.get_group(group)}
+        sys.stdout.flush()
+        try:
+            os.execvpe(command[0], command, env)
+        except (IndexError, OSError, ValueError):
+            raise err.CommandFailed(' '.join(command))
+
+    @staticmethod
+    def _resolve(entries, name):
+        # Names may hold dots, try every split into a group and a key.
+        parts = name.split('.')
+        for index in range(1, len(parts)):
+            group = '.'.join(parts[:index])
+            key = '.'.join(parts[index:])
+            if key in entries.get(group, {}):
+                return entries[group][key]
+        raise err.KeyNotExists(name)
+
+    def render_template(self, path, output):
+        # Streams the template line by line, each value is decrypted once.
+        entries = self.merge_layers()
+        values = {}
+
+        def replace(match):
+            name = match.group(1)
+            if name not in values:
+                value, codec = self._resolve(entries, name)
+                values[name] = codec.decode(value)
+            return values[name]
 
-        if not (decoded[group].get(key, None) is not None):
-            decoded[group][key] = value
-            self.vault = decoded
-            self.save_vault()
-        else:
+        try:
+            file = sys.stdin if path == '-' else open(path, 'r')
+        except FileNotFoundError:
+            raise err.FileNotFound(path)
+        with file:
+            for line in file:
+                output.write(PLACEHOLDER.sub(replace, line))
+        output.flush()
+
+    @staticmethod
+    def _rename(data, old, new):
+        # Rebuild the dict to keep the position of the renamed entry.
+        return {
+            new if name == old else name: value
+            for name, value in data.items()
+        }
+
+    @retry_on_conflict
+    def add_data(self, group, key, value):
+        crt_group = self.find_group(group)
+        if crt_group is None:
+            crt_group = self.codec.encode(group)
+            self.vault[crt_group] = {}
+        elif self.find_key(crt_group, key) is not None:
             raise err.KeyAlreadyExists(key)
 
+        self.vault[crt_group][self.codec.encode(key)] = (
+            self.codec.encode(value)
+        )
+        self.mark_dirty(crt_group)
+        self.save_vault()
+
+    @retry_on_conflict
     def update_data(
         self,
         group,
@@ -319,68 +953,104 @@ class Vault:
         new_key=None,
         new_value=None
     ):
-        decoded = self.decode_vault()
-        group_order = decoded.keys()
-        if decoded.get(group, None) is not None:
-            group_decoded = {}
-            for old_group in group_order:
-                data = decoded[old_group]
-                if old_group == group:
-                    group_decoded[new_group] = data
-                else:
-                    group_decoded[old_group] = data
-
-            decoded = group_decoded
-        else:
+        # Validate everything first so a failed update changes nothing.
+        crt_group = self.find_group(group)
+        if crt_group is None:
             raise err.GroupNotExists(group)
+        if new_group != group and self.find_group(new_group) is not None:
+            raise err.GroupAlreadyExists(new_group)
 
+        crt_key = None
         if key is not None and new_key is not None:
-            if decoded[new_group].get(key, None) is not None:
-                key_order = decoded[new_group].keys()
-
-                key_decoded = {}
-                for old_key in key_order:
-                    data = decoded[new_group][old_key]
-                    if old_key == key:
-                        key_decoded[new_key] = data
-                    else:
-                        key_decoded[old_key] = data
-                decoded[new_group] = key_decoded
-            else:
+            crt_key = self.find_key(crt_group, key)
+            if crt_key is None:
                 raise err.KeyNotExists(key)
+            if (
+                new_key != key
+                and self.find_key(crt_group, new_key) is not None
+            ):
+                raise err.KeyAlreadyExists(new_key)
+
+        if new_group != group:
+            new_crt_group = self.codec.encode(new_group)
+            self.vault = self._rename(self.vault, crt_group, new_crt_group)
+            self.mark_dirty(crt_group, new_crt_group)
+            crt_group = new_crt_group
+
+        if crt_key is not None and new_key != key:
+            new_crt_key = self.codec.encode(new_key)
+            self.vault[crt_group] = self._rename(
+                self.vault[crt_group], crt_key, new_crt_key
+            )
+            self.mark_dirty(crt_group)
+            crt_key = new_crt_key
+
+        if new_value is not None and crt_key is not None:
+            # Unchanged values keep their ciphertext byte-for-byte.
+            crt_value = self.vault[crt_group][crt_key]
+            if self.codec.decode(crt_value) != new_value:
+                self.vault[crt_group][crt_key] = (
+                    self.codec.encode(new_value)
+                )
+                self.mark_dirty(crt_group)
 
-        if new_value is not None:
-            decoded[new_group][new_key] = new_value
-
-        self.vault = decoded
         self.save_vault()
 
+    @retry_on_conflict
     def clear_data(self, group, key):
-        decoded = self.decode_vault()
-        if decoded.get(group, None) is not None:
-            if decoded[group].get(key, None) is not None:
-                del decoded[group][key]
-                if len(decoded[group]) == 0:
-                    del decoded[group]
-
-                self.vault = decoded
-                self.save_vault()
-            else:
-                raise err.KeyNotExists(key)
-        else:
+        crt_group = self.find_group(group)
+        if crt_group is None:
             raise err.GroupNotExists(group)
+        crt_key = self.find_key(crt_group, key)
+        if crt_key is None:
+            raise err.KeyNotExists(key)
+
+        del self.vault[crt_group][crt_key]
+        if len(self.vault[crt_group]) == 0:
+            del self.vault[crt_group]
+        self.mark_dirty(crt_group)
+        self.save_vault()
 
+    @retry_on_conflict
     def erase_data(self):
         self.vault = {}
+        self.dirty = None
         self.save_vault()
 
 
-def main():
-    is_piped = True
-    if sys.stdout.isatty():
-        is_piped = False
+def show_banner(is_piped):
+    if not is_piped:
+        from art import tprint
         tprint(f'\n{VAULT_TITLE.upper()}', font=TITLE_FONT)
 
+
+def run_tui(vlt):
+    # Textual and Rich are loaded only by the commands that open the TUI.
+    import tui
+    tui.ViewApp.run(title=VAULT_TITLE, vlt=vlt)
+
+
+def sign_in(vlt, login, rekey=True):
+    import agent
+    client = agent.AgentClient()
+    key, params = client.get_key(login)
+    if key is not None:
+        vlt.set_encoder_key(login, key, params)
+        try:
+            return vlt.sign_in()
+        except err.LoginFailed:
+            # The cached key may belong to another vault of the same login.
+            client.forget(login)
+
+    lpv = validators.LoginPasswordValidator(login)
+    vlt.get_user(lpv.login, lpv.password, rekey)
+    if client.is_running:
+        client.add_key(lpv.login, vlt.encoder.key, vlt.encoder.params)
+
+
+def main():
+    is_piped = not sys.stdout.isatty()
+
     parser = argparse.ArgumentParser(
         description=DESCRIPTION
     )
@@ -409,11 +1079,34 @@ def main():
         '-ld', '--load', dest='path', type=str,
         help='load decrypted data from JSON to the local vault'
     )
+    parser.add_argument(
+        '--policy', dest='policy', choices=LOAD_POLICIES,
+        default=LOAD_POLICY,
+        help='replace the vault, merge into it or skip existing entries '
+        'on load'
+    )
     main_group.add_argument(
         '-rm', '--remove', action='store_true',
         help='remove vault from the local DB'
     )
 
+    main_group.add_argument(
+        '--import-db', dest='import_db', type=str, metavar='PATH',
+        help='import encrypted vaults from a JSON DB to the source DB'
+    )
+    main_group.add_argument(
+        '--export-db', dest='export_db', type=str, metavar='PATH',
+        help='export encrypted vaults from the source DB to a JSON DB'
+    )
+    main_group.add_argument(
+        '--publish', dest='publish', type=str, metavar='PATH',
+        help='publish the source DB as a JSON DB with an index of vaults'
+    )
+    main_group.add_argument(
+        '--compact', action='store_true',
+        help='compact the log of the source DB'
+    )
+
     # info actions
     main_group.add_argument(
         '-f', '--find', action='store_true',
@@ -428,10 +1121,37 @@ def main():
         help='show version'
     )
 
+    # agent
+    main_group.add_argument(
+        '-ag', '--agent', nargs='?', const=AGENT_TTL, type=int,
+        metavar='TTL',
+        help='start an agent that keeps unlocked vaults for TTL seconds'
+    )
+    main_group.add_argument(
+        '--agent-stop', action='store_true',
+        help='forget unlocked vaults and stop the agent'
+    )
+
+    main_group.add_argument(
+        '--calibrate', nargs='?', const=CALIBRATE_TIME, type=int,
+        metavar='MS',
+        help='pick key derivation parameters for an unlock time in ms'
+    )
+
     # select source
     parser.add_argument(
-        '-s', '--source', dest='source', type=str,
-        help='load encrypted vault from the source DB'
+        '-s', '--source', action='append', dest='source', type=str,
+        metavar='SOURCE',
+        help='load encrypted vault from the source DB, repeat to merge '
+        'more sources read-only under the first one'
+    )
+    main_group.add_argument(
+        '--convert', dest='convert', choices=VAULT_FORMATS,
+        help='convert the local vault to another storage format'
+    )
+    parser.add_argument(
+        '-w', '--workers', dest='workers', type=int,
+        help='number of workers for batch encryption and decryption'
     )
     parser.add_argument(
         '-g', '--get', nargs=2, dest='get', type=str,
@@ -442,6 +1162,24 @@ def main():
         '-l', '--list', action='store_true',
         help='list data from the source vault'
     )
+    parser.add_argument(
+        '-b', '--batch', action='store_true',
+        help='answer NDJSON get, list and exists queries from stdin'
+    )
+    parser.add_argument(
+        '--exec', dest='exec_group', type=str, metavar='GROUP',
+        help='run the command after -- with the keys of GROUP in its '
+        'environment'
+    )
+    parser.add_argument(
+        '--render', dest='render', type=str, metavar='TEMPLATE',
+        help='fill {{group.key}} placeholders of TEMPLATE to stdout'
+    )
+    parser.add_argument(
+        '--serve', nargs='?', const='', type=str, metavar='ADDRESS',
+        help='serve the source vault over HTTP on a socket, or on '
+        'HOST:PORT when VAULT_SERVE_TOKEN is set'
+    )
     main_group.add_argument(
         '-a', '--add', nargs=3, dest='add', type=str,
         metavar=('GROUP', 'KEY', 'VALUE'),
@@ -462,32 +1200,54 @@ def main():
         help='erase all data in the local vault'
     )
 
-    args = parser.parse_args()
+    # Everything after -- is the command of --exec, options included.
+    argv = sys.argv[1:]
+    command = []
+    if '--' in argv:
+        index = argv.index('--')
+        argv, command = argv[:index], argv[index + 1:]
+    args = parser.parse_args(argv)
 
     if (
         not args.login
         and not (
             args.find or args.version or args.info
+            or args.agent is not None or args.agent_stop
+            or args.calibrate is not None or args.compact
+            or args.import_db or args.export_db or args.publish
         )
     ):
         parser.error('the following arguments are required: login')
 
-    vlt = Vault(args.source, is_piped)
+    # Neither opens a source, both stay as fast as the imports.
+    if args.version:
+        return Vault.version()
+    if args.info:
+        return Vault.info()
+
+    sources = args.source or [None]
+    vlt = Vault(sources[0], is_piped, args.workers)
+    vlt.set_overlays(sources[1:])
 
     if args.sign_up:
+        show_banner(is_piped)
         lpv = validators.LoginPasswordValidator(args.login)
         try:
             lpv.is_valid()
             vlt.set_user(lpv.login, lpv.password)
-            tui.ViewApp.run(title=VAULT_TITLE, vlt=vlt)
+            run_tui(vlt)
         except (
             err.ActionNotAllowedForRemote,
             err.LocalDataBaseNotFound,
             err.FileNotFound,
+            err.SourceUnavailable,
             err.InvalidJSON,
             err.InvalidEmail,
             err.InvalidPassword,
+            err.InvalidFormat,
             err.InvalidURL,
+            err.DataBaseTooLarge,
+            err.WriteConflict,
             err.UserExists
         ) as e:
             err.show_error(e)
@@ -496,54 +1256,117 @@ def main():
             vlt.find_database(vlt.get_database_path())
         except err.LocalDataBaseNotFound as e:
             err.show_error(e)
-    elif args.version:
-        vlt.version()
-    elif args.info:
-        vlt.info()
+    elif args.agent is not None:
+        import agent
+        try:
+            err.show_notification(agent.start(args.agent))
+        except err.UnsafeSocket as e:
+            err.show_error(e)
+    elif args.import_db or args.export_db or args.publish:
+        try:
+            if args.import_db:
+                vlt.import_database(args.import_db)
+            elif args.export_db:
+                vlt.export_database(args.export_db)
+            else:
+                vlt.publish_database(args.publish)
+        except (
+            err.ActionNotAllowedForRemote,
+            err.LocalDataBaseNotFound,
+            err.FileNotFound,
+            err.SourceUnavailable,
+            err.InvalidJSON,
+            err.InvalidDataFormat,
+            err.InvalidURL,
+            err.DataBaseTooLarge
+        ) as e:
+            err.show_error(e)
+    elif args.compact:
+        try:
+            vlt.compact_database()
+        except (
+            err.ActionNotAllowedForRemote,
+            err.LocalDataBaseNotFound
+        ) as e:
+            err.show_error(e)
+    elif args.calibrate is not None:
+        vlt.calibrate(args.calibrate)
+    elif args.agent_stop:
+        import agent
+        if not agent.AgentClient().stop():
+            err.show_error(err.AgentNotRunning())
     else:
-
-        lpv = validators.LoginPasswordValidator(args.login)
+        # Re-keying needs a second key derivation, only writes pay it.
+        is_read_only = (
+            args.dump or args.get or args.list or args.batch
+            or args.serve is not None or args.exec_group or args.render
+        )
+        if not (is_read_only or args.remove or args.convert):
+            show_banner(is_piped)
         try:
-            vlt.get_user(lpv.login, lpv.password)
+            sign_in(vlt, args.login, rekey=not is_read_only)
+            vlt.open_overlays()
 
             if args.dump:
                 vlt.dump_data(vlt.get_json_path())
             elif args.path:
-                vlt.load_data(args.path)
-                tui.ViewApp.run(title=VAULT_TITLE, vlt=vlt)
+                report = vlt.load_data(args.path, args.policy)
+                err.show_notification(vlt.load_summary(report))
+                for error in report['errors']:
+                    err.show_warning(error)
+                run_tui(vlt)
             elif args.remove:
                 vlt.remove_vault()
+            elif args.exec_group:
+                vlt.exec_command(args.exec_group, command)
+            elif args.render:
+                vlt.render_template(args.render, sys.stdout)
+            elif args.serve is not None:
+                import sidecar
+                sidecar.serve(vlt, args.serve)
+            elif args.batch:
+                vlt.process_batch(sys.stdin, sys.stdout)
             elif args.get:
                 vlt.get_data(*args.get)
             elif args.list:
                 vlt.list_data()
             elif args.add:
                 vlt.add_data(*args.add)
-                tui.ViewApp.run(title=VAULT_TITLE, vlt=vlt)
+                run_tui(vlt)
             elif args.update:
                 vlt.update_data(*args.update)
-                tui.ViewApp.run(title=VAULT_TITLE, vlt=vlt)
+                run_tui(vlt)
             elif args.clear:
                 vlt.clear_data(*args.clear)
-                tui.ViewApp.run(title=VAULT_TITLE, vlt=vlt)
+                run_tui(vlt)
+            elif args.convert:
+                vlt.convert_vault(args.convert)
             elif args.erase:
                 vlt.erase_data()
-                tui.ViewApp.run(title=VAULT_TITLE, vlt=vlt)
+                run_tui(vlt)
             else:
-                tui.ViewApp.run(title=VAULT_TITLE, vlt=vlt)
+                run_tui(vlt)
 
         except (
             err.ActionNotAllowedForRemote,
             err.LocalDataBaseNotFound,
             err.FileNotFound,
+            err.SourceUnavailable,
             err.InvalidJSON,
             err.InvalidDataFormat,
             err.InvalidURL,
+            err.DataBaseTooLarge,
             err.LoginFailed,
+            err.InvalidFormat,
             err.GroupNotExists,
             err.GroupAlreadyExists,
             err.KeyNotExists,
             err.KeyAlreadyExists,
+            err.WriteConflict,
+            err.AddressUnavailable,
+            err.TokenRequired,
+            err.UnsafeSocket,
+            err.CommandFailed,
         ) as e:
             try:
                 err.show_error(e)
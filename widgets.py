@@ -73,8 +73,7 @@ class CellButton(ButtonMixin, Button):
     ):
         super().__init__(*args, **kwargs)
         self.encoder = encoder
-        self.title = self.encoder.decode(title)
-        self.label = self.encoder.decode(self.label)
+        self.title = title
         self.value = value
         self.on_click_label = KEY
 